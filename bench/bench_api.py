@@ -0,0 +1,271 @@
+#!/usr/bin/env python2
+'''Benchmark API and webedit endpoints in-process.
+
+Runs isrv.api.app and isrv.webedit.app through WSGI with the App Engine
+testbed stubs (datastore, memcache, taskqueue ...) over a synthetic corpus (see
+corpus.py). For each endpoint reports latency percentiles and RPCs per request
+and fails (exit code 1) if datastore RPCs per request are over budget, so a
+regression like a new N+1 query in to_dict is caught.
+
+Usage: PYTHONPATH=. python2 bench/bench_api.py [-h]
+'''
+from __future__ import print_function
+
+from argparse import ArgumentParser
+from collections import Counter
+from os import environ
+from os.path import abspath, dirname
+import json
+import os
+import sys
+import time
+
+root = dirname(dirname(abspath(__file__)))
+sdk = environ.get('GAE_SDK', '/opt/google_appengine')
+
+
+def fix_sys_path():
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    if root not in sys.path:
+        sys.path.insert(0, root)
+
+
+class RPCCounter(object):
+    '''apiproxy pre call hook counting RPCs per service'''
+    def __init__(self):
+        self.counts = Counter()
+
+    def __call__(self, service, call, request, response):
+        self.counts[service] += 1
+
+    def reset(self):
+        self.counts.clear()
+
+
+class Endpoint(object):
+    def __init__(self, name, app, method, path, budget, body=None,
+                 headers=None):
+        self.name = name
+        self.app = app
+        self.method = method
+        self.path = path
+        self.budget = budget  # Max datastore RPCs per request
+        self.body = body
+        self.headers = headers or {}
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    idx = int(round((len(values) - 1) * pct / 100.0))
+    return values[idx]
+
+
+class Bench(object):
+    def __init__(self, args):
+        self.args = args
+
+    def setup(self):
+        from google.appengine.api import apiproxy_stub_map
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(
+            USER_EMAIL='bench@example.com',
+            USER_ID='1',
+            USER_IS_ADMIN='1',
+            overwrite=True,
+        )
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=root)
+        self.testbed.init_user_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+
+        self.counter = RPCCounter()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'bench-rpc-counter', self.counter.__call__)
+
+    def teardown(self):
+        self.testbed.deactivate()
+
+    def seed(self):
+        import corpus
+        from isrv import webedit
+
+        start = time.time()
+        self.corpus = corpus.generate(
+            channels=self.args.channels,
+            posts=self.args.posts,
+            comments=self.args.comments,
+            votes=self.args.votes,
+        )
+        webedit.Editor(email='bench@example.com').put()
+        print('corpus: {} ({:.1f}sec)'.format(
+            json.dumps(self.corpus.params, sort_keys=True),
+            time.time() - start))
+
+    def endpoints(self):
+        from isrv import api, webedit
+        from isrv.db import encode_key, update_shards
+
+        c = self.corpus
+        auth = {'Authorization': c.token}
+        chan = encode_key(c.channels[0].key)
+        post = encode_key(c.posts[0].key)
+        comment = encode_key(c.comments[0].key) if c.comments else post
+        nitems = min(self.args.items, len(c.posts))
+        items = '&'.join(
+            'key=' + encode_key(p.key) for p in c.posts[:nitems])
+        ncomm = self.args.comments
+        page = self.args.page
+        body = json.dumps({
+            'content': 'bench', 'role': 'role', 'role_text': 'role text',
+            'theme': 'theme', 'background': 'bg', 'channels': [chan],
+        })
+
+        # Budgets are datastore RPCs per request, per item budgets are 3 for
+        # posts (comments + up/down votes queries) and 2 for comments, webedit
+        # base budgets include loading the editors and edit users caches
+        return [
+            Endpoint('channels', api.app, 'GET', '/api/v1/channels/', 3,
+                     headers=auth),
+            Endpoint('channel feed', api.app, 'GET',
+                     '/api/v1/channels/{}?count={}'.format(chan, page),
+                     5 + 3 * page, headers=auth),
+            Endpoint('post', api.app, 'GET', '/api/v1/posts/' + post, 6,
+                     headers=auth),
+            Endpoint('comments', api.app, 'GET', '/api/v1/comments/' + post,
+                     3 + 2 * ncomm, headers=auth),
+            Endpoint('items', api.app, 'GET', '/api/v1/items/?' + items,
+                     3 + 3 * nitems, headers=auth),
+            Endpoint('updates', api.app, 'GET', '/api/v1/updates/?' + items,
+                     # Query per shard, post get and to_dict per key
+                     2 + nitems * (update_shards + 4), headers=auth),
+            Endpoint('icons', api.app, 'GET', '/api/v1/icons', 0),
+            # Sum of the above budgets, auth and shared entities loaded once
+            Endpoint('batch', api.app, 'POST', '/api/v1/batch',
+                     3 + 5 + 3 * page + 3 + 3 * nitems,
+                     body=json.dumps({'requests': [
+                         {'path': '/channels/'},
+                         {'path': '/channels/{}?count={}'.format(chan, page)},
+                         {'path': '/items/?' + items},
+                         {'path': '/icons'},
+                     ]}),
+                     headers=auth),
+            Endpoint('we posts', webedit.app, 'GET',
+                     '/_we/js/posts/?count={}'.format(page),
+                     8 + 4 * page),
+            Endpoint('we comments', webedit.app, 'GET',
+                     '/_we/js/comments/' + post, 8 + 3 * ncomm),
+            # Writes last so they don't change the read endpoints data
+            Endpoint('vote', api.app, 'POST',
+                     '/api/v1/votes/{}/up'.format(comment), 15, headers=auth),
+            Endpoint('new comment', api.app, 'POST',
+                     '/api/v1/comments/' + post, 10,
+                     body=body, headers=auth),
+            Endpoint('new post', api.app, 'POST', '/api/v1/posts/', 4,
+                     body=body, headers=auth),
+        ]
+
+    def request(self, endpoint):
+        import webapp2
+        from google.appengine.ext import ndb
+
+        req = webapp2.Request.blank(endpoint.path, headers=endpoint.headers)
+        req.method = endpoint.method
+        if endpoint.body is not None:
+            req.body = endpoint.body
+        # New request, new context cache (like on App Engine)
+        ndb.get_context().clear_cache()
+        return req.get_response(endpoint.app)
+
+    def run_endpoint(self, endpoint):
+        times, rpcs, other = [], [], []
+        for _ in range(self.args.runs):
+            self.counter.reset()
+            start = time.time()
+            resp = self.request(endpoint)
+            times.append((time.time() - start) * 1000)
+            if resp.status_int != 200:
+                raise AssertionError('{}: HTTP {}'.format(
+                    endpoint.name, resp.status))
+            counts = self.counter.counts
+            rpcs.append(counts['datastore_v3'])
+            other.append(sum(counts.values()) - counts['datastore_v3'])
+
+        return {
+            'p50': percentile(times, 50),
+            'p90': percentile(times, 90),
+            'p99': percentile(times, 99),
+            'max': max(times),
+            'rpcs': max(rpcs),
+            'other': max(other),
+        }
+
+    def run(self):
+        self.setup()
+        try:
+            self.seed()
+            failed = []
+            fmt = '{:14} {:>8} {:>8} {:>8} {:>8} {:>6} {:>6} {:>6}'
+            print(fmt.format('endpoint', 'p50 ms', 'p90 ms', 'p99 ms',
+                             'max ms', 'ds', 'budget', 'other'))
+            for endpoint in self.endpoints():
+                if self.args.only and endpoint.name not in self.args.only:
+                    continue
+                res = self.run_endpoint(endpoint)
+                over = res['rpcs'] > endpoint.budget
+                if over:
+                    failed.append(endpoint.name)
+                print(fmt.format(
+                    endpoint.name,
+                    '{:.1f}'.format(res['p50']),
+                    '{:.1f}'.format(res['p90']),
+                    '{:.1f}'.format(res['p99']),
+                    '{:.1f}'.format(res['max']),
+                    res['rpcs'],
+                    '{}{}'.format(endpoint.budget, '!' if over else ''),
+                    res['other'],
+                ))
+        finally:
+            self.teardown()
+
+        if failed:
+            print('over datastore RPC budget: {}'.format(', '.join(failed)))
+            return 1
+        return 0
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--posts', type=int, default=20,
+                        help='posts per channel')
+    parser.add_argument('--comments', type=int, default=5,
+                        help='comments per post')
+    parser.add_argument('--votes', type=int, default=5,
+                        help='votes per post/comment')
+    parser.add_argument('--items', type=int, default=10,
+                        help='keys in items/updates requests')
+    parser.add_argument('--page', type=int, default=20,
+                        help='feed/webedit page size')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='requests per endpoint')
+    parser.add_argument('--only', action='append',
+                        help='run only this endpoint (can repeat)')
+    args = parser.parse_args(argv)
+
+    fix_sys_path()
+    os.chdir(root)  # icons.json, templates
+    return Bench(args).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+'''Synthetic corpus for benchmarks.
+
+Must run with the App Engine testbed (or dev_appserver) active.
+'''
+from isrv import db
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from random import Random
+
+Corpus = namedtuple(
+    'Corpus', 'channels users posts comments token params')
+
+
+def generate(channels=2, posts=20, comments=5, votes=5, users=10, seed=17):
+    '''Create channels with posts, each post has `comments` comments and
+    `votes` votes (on the post and on each comment) and an update per
+    object.'''
+    rnd = Random(seed)
+    now = datetime.now()
+    params = {
+        'channels': channels, 'posts': posts, 'comments': comments,
+        'votes': votes, 'users': users,
+    }
+
+    chans = [db.Channel.create('bench channel #{}'.format(i))
+             for i in range(channels)]
+    usrs = [db.User.create('bench-user #{}'.format(i), use_hash=False)
+            for i in range(users)]
+
+    all_posts, all_comments = [], []
+    for i in range(posts * channels):
+        chan = chans[i % channels]
+        created = now - timedelta(minutes=i + 1)
+        post = db.Post.create(
+            rnd.choice(usrs),
+            'bench post #{}'.format(i),
+            'theme',
+            'background',
+            [db.encode_key(chan.key)],
+            'role',
+            'role text',
+            created=created,
+        )
+        all_posts.append(post)
+        objs = [post]
+        for j in range(comments):
+            comment = db.Comment.create(
+                post,
+                rnd.choice(usrs),
+                'bench comment #{}/{}'.format(i, j),
+                'role',
+                'role text',
+                created=created + timedelta(seconds=j + 1),
+            )
+            all_comments.append(comment)
+            objs.append(comment)
+
+        for obj in objs:
+            for _ in range(votes):
+                direction = 'up' if rnd.random() < 0.8 else 'down'
+                db.Vote.create(obj, rnd.choice(usrs), direction,
+                               delete_opposite=False)
+            db.Update.create(chan, obj.key, created)
+
+    token = usrs[0].login()
+    return Corpus(chans, usrs, all_posts, all_comments, token, params)
@@ -9,19 +9,47 @@ from isrv import db
 
 ndb.delete_multi(db.Post.query().iter(keys_only=True))
 ndb.delete_multi(db.Comment.query().iter(keys_only=True))
+ndb.delete_multi(db.PostUsers.query().iter(keys_only=True))
 ndb.delete_multi(db.Update.query().iter(keys_only=True))
 ndb.delete_multi(db.UpVote.query().iter(keys_only=True))
 ndb.delete_multi(db.DownVote.query().iter(keys_only=True))
 
-''' Deleting a post
+''' Deleting a post (or a comment), related objects are deleted in background
+    tasks, check progress with /_we/js/jobs/<job>
 '''
 from google.appengine.ext import ndb
-from isrv import db
+from isrv import api
 
 post_key = '<key-from-datastore>'
 ndb_key = ndb.Key(urlsafe=post_key)
-ndb.delete_multi(db.Comment.query(ancestor=ndb_key).iter(keys_only=True))
-ndb.delete_multi(db.Update.query(ancestor=ndb_key).iter(keys_only=True))
-ndb.delete_multi(db.UpVote.query(ancestor=ndb_key).iter(keys_only=True))
-ndb.delete_multi(db.DownVote.query(ancestor=ndb_key).iter(keys_only=True))
-ndb_key.delete()
\ No newline at end of file
+ndb_key.delete()
+job = api.start_cascade_delete(ndb_key)
+print(job.key.urlsafe())
+
+
+''' Migrations and backfills run as mappers (see isrv/mapper.py) in background
+    tasks, check progress with /_we/js/jobs/<job>. List mappers with
+    GET /_we/js/mappers/, start with POST /_we/js/mappers/<name> or:
+'''
+from isrv import api
+
+# Re-put so properties changed to indexed=False are dropped from indexes.
+# Updates written before Update.sort are found by readers once re-put (needs
+# the Update (post, -sort) indexes serving first).
+for kind in ['User', 'Post', 'Comment', 'UpVote', 'DownVote', 'Update',
+             'Flag', 'Feedback']:
+    print(api.start_mapper('reput-' + kind).key.urlsafe())
+
+# Move Post.uid_map to PostUsers
+print(api.start_mapper('migrate-post-users').key.urlsafe())
+
+# Scheduled publishing: index Comment.published (needs the Comment
+# (published, -created) index serving first) and schedule future posts, when
+# both are done set db.publishing_migrated = True and deploy
+for kind in ['Post', 'Comment']:
+    print(api.start_mapper('schedule-' + kind).key.urlsafe())
+
+# Key votes by post user id, when both are done set db.votes_keyed = True and
+# deploy (my votes are then looked up by key only)
+for kind in ['UpVote', 'DownVote']:
+    print(api.start_mapper('key-' + kind).key.urlsafe())
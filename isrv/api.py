@@ -1,22 +1,53 @@
+from . import bulk
+from . import coalesce
 from . import db
+from . import mapper
+from . import profiling
+from . import telemetry
+from .idempotency import idempotent
 
 import webapp2
 from google.appengine.api import taskqueue
 from google.appengine.api import mail
-from google.appengine.api import memcache
 from google.appengine.api import app_identity
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
 
 from datetime import datetime
 from operator import itemgetter
 from os import environ
+import time
 import httplib
 import json
 import logging as log
 
 update_task_url = '/tasks/publisher'
+flag_digest_task_url = '/tasks/flag-digest'
+# Old per flag mail task, see FlagTask
 flag_task_url = '/tasks/flag'
+recount_flags_task_url = '/tasks/recount-flags'
+# Flags stored while their Moderation is contended are counted this much later
+# (seconds), so one task counts a burst of them
+recount_flags_delay = 5
 feedback_task_url = '/tasks/feedback'
-time_fmt = '%Y-%m-%dT%H:%M:%SZ'
+compact_task_url = '/tasks/compact-updates'
+cascade_delete_task_url = '/tasks/cascade-delete'
+mapper_task_url = '/tasks/mapper'
+purge_replies_task_url = '/tasks/purge-replies'
+import_task_url = '/tasks/import'
+# Sub-requests of a batch request get the batch user in request environ
+batch_user_key = 'isrv.batch_user'
+max_batch = 20
+max_my_votes = 300
+# Feed pages and items are cached this long (seconds, see coalesce)
+feed_ttl = 5
+items_ttl = 5
+# Prefetch the next page of every feed request (otherwise only of requests
+# with prefetch=1), see PrefetchFeedTask
+prefetch_feed = False
+prefetch_feed_task_url = '/tasks/prefetch-feed'
+publish_task_url = '/tasks/publish'
+time_fmt = db.time_fmt
 hashkey = itemgetter('hash')
 
 
@@ -40,20 +71,36 @@ def jsonify(obj):
     return json.dumps(obj, cls=JSONEncoder)
 
 
+def toplevel(method):
+    '''ndb.toplevel handler method, method.tasklet is the tasklet version
+    (used by BatchHandler to run several handlers in one context)'''
+    wrapper = ndb.toplevel(method)
+    wrapper.tasklet = ndb.tasklet(method)
+    return wrapper
+
+
 class RequestHandler(webapp2.RequestHandler):
     dbtype = None
 
     def get_user(self):
+        return self.get_user_async().get_result()
+
+    @ndb.tasklet
+    def get_user_async(self):
+        user = self.request.environ.get(batch_user_key)
+        if user:
+            raise ndb.Return(user)
+
         token = self.request.headers.get('Authorization')
         if not token:
             log.error('no auth')
             self.abort(httplib.UNAUTHORIZED)
 
-        user = db.User.from_token(token)
+        user = yield db.User.from_token_async(token)
         if not user:
             log.error('unknown user')
             self.abort(httplib.UNAUTHORIZED)
-        return user
+        raise ndb.Return(user)
 
     def assert_internal(self, header):
         if is_local_srv():
@@ -69,28 +116,30 @@ class RequestHandler(webapp2.RequestHandler):
 
     def json_reply(self, obj):
         self.set_json_header()
-        data = jsonify(obj)
-        set_cached(self, data)
-        self.response.write(data)
+        self.response.write(jsonify(obj))
 
     def key_reply(self, obj):
         self.json_reply({'ok': True, 'key': obj.key})
 
     # Default get method
+    @toplevel
     def get(self, key=None):
-        self.get_user()  # Make sure we're authorized
+        # Authorize while we load the object
+        user_future = self.get_user_async()
+        obj_future = db.Model.from_key_async(key) if key else None
+        yield user_future
         if not key:
             log.error('no key')
             self.abort(httplib.BAD_REQUEST)
 
-        obj = db.Model.from_key(key)
+        obj = yield obj_future
         if not obj:
             log.error('no such key: %s', key)
             self.abort(httplib.NOT_FOUND)
 
         name = self.dbtype.__name__.lower()
-        # FIXME: Add key to dict
-        self.json_reply({'ok': True, name: obj.to_dict()})
+        dicts = yield db.to_dicts_async([obj], fields=self.fields())
+        self.json_reply({'ok': True, name: dicts[0]})
 
     def request_json(self):
         return json.loads(self.request.body)
@@ -107,36 +156,90 @@ class RequestHandler(webapp2.RequestHandler):
             log.error('bad value for %s - %s', name, val)
             self.abort(httplib.BAD_REQUEST)
 
+    def fields(self):
+        '''Fields requested with ?fields=f1,f2 (None means all)'''
+        return self.get_param('fields', parse_fields, None)
 
-# NOTE: The below three are a hack to guard against Twisted sending requests
-# mutiple times
-def request_id(handler):
-    return handler.request.get('rid')
-
-
-def get_cached(handler):
-    reqid = request_id(handler)
-    if not reqid:
-        log.warning('missing request id')
 
-    return memcache.get(reqid)
+def parse_fields(val):
+    return set(field.strip() for field in val.split(',') if field.strip())
 
 
-def set_cached(handler, reply):
-    rid = request_id(handler)
-    if not rid:
-        return
+def notify_update(channels, obj, transactional=False):
+    notify_update_async(channels, obj, transactional).get_result()
 
-    memcache.set(rid, reply, 60)  # TODO: Find good timeout
 
-
-def notify_update(channels, obj):
+@ndb.tasklet
+def notify_update_async(channels, obj, transactional=False):
     msg = jsonify({
         'time': datetime.now(),
         'key': obj.key,
         'channels': channels,
     })
-    taskqueue.add(url=update_task_url, params={'update': msg})
+    task = taskqueue.Task(url=update_task_url, params={'update': msg})
+    yield taskqueue.Queue().add_async(task, transactional=transactional)
+
+
+@ndb.transactional(xg=True)
+def publish(pending_key):
+    '''Publish scheduled object of pending entry and notify its channels,
+    returns the object (None if there was nothing to publish)'''
+    pending = pending_key.get()
+    if not pending:
+        return None
+
+    obj = pending.what.get()
+    if obj and not obj.is_due():
+        # Created time was moved forward after scheduling
+        pending.publish_at = obj.created
+        pending.put()
+        return None
+
+    pending.key.delete()
+    if not obj or obj.published:
+        return None
+
+    obj.publish()
+    obj.put()
+    notify_update(obj.parent_post().channels, obj, transactional=True)
+    return obj
+
+
+@ndb.transactional
+def save_job(job, url, delete=()):
+    '''Checkpoint job and (if not done) chain the next task for it, delete
+    are keys of the job children to delete with the checkpoint'''
+    job.put()
+    if delete:
+        ndb.delete_multi(delete)
+    if not job.done:
+        taskqueue.add(url=url, params={'job': job.key.urlsafe()},
+                      transactional=True)
+
+
+def start_cascade_delete(key):
+    '''Start background delete of everything related to key, returns job'''
+    job = db.Job(name='cascade-delete', target=key, stage=db.cascade_stages[0])
+    save_job(job, cascade_delete_task_url)
+    return job
+
+
+def start_mapper(name):
+    '''Start registered mapper in background tasks, returns job'''
+    if not mapper.get_mapper(name):
+        raise db.NotFound(name)
+    job = db.Job(name=name)
+    save_job(job, mapper_task_url)
+    return job
+
+
+def start_import(items, default_channel=None):
+    '''Import posts (see bulk) in background tasks, returns job'''
+    job = db.Job(name='import', target=default_channel)
+    job.put()
+    bulk.stage_import(job, items)
+    save_job(job, import_task_url)
+    return job
 
 
 class RegisterHandler(RequestHandler):
@@ -198,15 +301,10 @@ class LoginHandler(RequestHandler):
 class PostsHandler(RequestHandler):
     dbtype = db.Post
 
+    @idempotent
     def post(self, ignored=None):
         user = self.get_user()
 
-        out = get_cached(self)
-        if out:
-            self.set_json_header()
-            self.request.write(out)
-            return
-
         data = self.request_json()
 
         required = set([
@@ -235,20 +333,18 @@ class PostsHandler(RequestHandler):
 class CommentsHandler(RequestHandler):
     dbtype = db.Comment
 
+    @idempotent
+    @toplevel
     def post(self, post_key=None):
-        user = self.get_user()
-
-        out = get_cached(self)
-        if out:
-            self.set_json_header()
-            self.request.write(out)
-            return
+        user_future = self.get_user_async()
+        post_future = db.Post.from_key_async(post_key) if post_key else None
+        user = yield user_future
 
         if not post_key:
             log.error('no post_key')
             self.abort(httplib.BAD_REQUEST)
 
-        post = db.Post.from_key(post_key)
+        post = yield post_future
         if not post:
             log.error('unknown post - %s', post_key)
             self.abort(httplib.BAD_REQUEST)
@@ -267,41 +363,45 @@ class CommentsHandler(RequestHandler):
             log.error('missing fields: %s', ', '.join(missing))
             self.abort(httplib.BAD_REQUEST)
 
-        comment = db.Comment.create(
+        comment = yield db.Comment.create_async(
             post,
             user,
             data['content'],
             data['role'],
             data['role_text'],
         )
-        notify_update(post.channels, comment)
+        yield notify_update_async(post.channels, comment)
         self.key_reply(comment)
 
+    @toplevel
     def get(self, post_key=None):
         if not post_key:
             log.error('no post key')
             self.abort(httplib.BAD_REQUEST)
 
-        post = db.Post.from_key(post_key)
+        post = yield db.Post.from_key_async(post_key)
         if not post:
             log.error('no such post - %s', post_key)
             self.abort(httplib.NOT_FOUND)
+        telemetry.record('read.comments', post.key)
 
-        comments = [comm.to_dict() for comm in post.comments()]
+        comments = yield post.comments_query().fetch_async()
+        comments = [comm for comm in comments if not comm.hidden]
+        comments = yield db.to_dicts_async(comments, fields=self.fields())
         self.json_reply({'ok': True, 'comments': comments})
 
 
 class VotesHandler(RequestHandler):
     dbtype = db.UpVote
+    count_fields = set(['upvote_count', 'downvote_count'])
 
-    def post(self, key=None, direction=None):
-        user = self.get_user()
-
-        out = get_cached(self)
-        if out:
-            self.set_json_header()
-            self.request.write(out)
-            return
+    @ndb.tasklet
+    def vote_target(self, key, direction):
+        '''User, voted object and direction (user and object are loaded
+        concurrently)'''
+        user_future = self.get_user_async()
+        obj_future = db.Model.from_key_async(key) if key else None
+        user = yield user_future
 
         if not (direction and key):
             log.error('bad path')
@@ -312,7 +412,7 @@ class VotesHandler(RequestHandler):
             log.error('bad direction')
             self.abort(httplib.BAD_REQUEST)
 
-        obj = db.Model.from_key(key)
+        obj = yield obj_future
         if not obj:
             log.error('object not found - %s', key)
             self.abort(httplib.NOT_FOUND)
@@ -321,53 +421,66 @@ class VotesHandler(RequestHandler):
             log.error('bad vote object - %s', obj.__class__)
             self.abort(httplib.BAD_REQUEST)
 
-        vote = db.Vote.create(obj, user, direction)
-        notify_update(obj.parent_post().channels, vote)
-        resp = {
+        raise ndb.Return((user, obj, direction))
+
+    def counts_reply(self, obj, upvote_count, downvote_count):
+        self.json_reply({
             'ok': True,
             'key': obj.key,
-            'upvote_count': len(obj.upvotes()),
-            'downvote_count': len(obj.downvotes()),
-        }
-        self.json_reply(resp)
+            'upvote_count': upvote_count,
+            'downvote_count': downvote_count,
+        })
 
+    @idempotent
+    @toplevel
+    def post(self, key=None, direction=None):
+        user, obj, direction = yield self.vote_target(key, direction)
+        vote = yield db.Vote.create_async(obj, user, direction)
+        post = yield obj.parent_post_async()  # In context cache
+        counts = obj.counts_async(fields=self.count_fields)
+        up, down, _ = yield (counts['upvote_count'], counts['downvote_count'],
+                             notify_update_async(post.channels, vote))
+        self.counts_reply(obj, up, down)
+
+    @idempotent
+    @toplevel
     def delete(self, key=None, direction=None):
-        user = self.get_user()
+        user, obj, direction = yield self.vote_target(key, direction)
+        yield db.Vote.delete_async(obj, user, direction)
+        # TODO: how to notify when a vote has been removed?
+        # notify_update(obj.parent_post().channels, vote)
+        counts = obj.counts_async(fields=self.count_fields)
+        up, down = yield counts['upvote_count'], counts['downvote_count']
+        self.counts_reply(obj, up, down)
 
-        out = get_cached(self)
-        if out:
-            self.set_json_header()
-            self.request.write(out)
-            return
 
-        if not (direction and key):
-            log.error('bad path')
-            self.abort(httplib.BAD_REQUEST)
+class MyVotesHandler(RequestHandler):
+    '''Vote direction of the user on each of the ?key= posts and comments'''
+    @toplevel
+    def get(self):
+        user_future = self.get_user_async()
+        keys = uniquify(self.request.get('key', allow_multiple=True))
+        user = yield user_future
 
-        direction = direction.lower()
-        if direction not in ('up', 'down'):
-            log.error('bad direction')
+        if not keys:
+            log.error('no keys')
             self.abort(httplib.BAD_REQUEST)
 
-        obj = db.Model.from_key(key)
-        if not obj:
-            log.error('object not found - %s', key)
-            self.abort(httplib.NOT_FOUND)
+        if len(keys) > max_my_votes:
+            log.error('too many keys - %d', len(keys))
+            self.abort(httplib.BAD_REQUEST)
 
-        if not isinstance(obj, db.Votable):
-            log.error('bad vote object - %s', obj.__class__)
+        decoded = [db.decode_key_or_none(key) for key in keys]
+        if None in decoded:
+            log.error('bad keys - %s', keys)
             self.abort(httplib.BAD_REQUEST)
 
-        db.Vote.delete(obj, user, direction)
-        # TODO: how to notify when a vote has been removed?
-        # notify_update(obj.parent_post().channels, vote)
-        resp = {
+        votes = yield db.my_votes_async(user, decoded)
+        self.json_reply({
             'ok': True,
-            'key': obj.key,
-            'upvote_count': len(obj.upvotes()),
-            'downvote_count': len(obj.downvotes()),
-        }
-        self.json_reply(resp)
+            'votes': dict((db.encode_key(key), vote)
+                          for key, vote in votes.iteritems()),
+        })
 
 
 def str2dt(v):
@@ -385,15 +498,18 @@ def uniquify(items, keyfn=identity):
             if keyfn(item) not in seen]
 
 
-def update2dict(update):
-    # TODO: this isn't optimal but ensures correctness
-    if update.post:
-        post = update.post.get()
-        if post:
-            return {
-                'obj': post.to_dict(),
-                'hash': update.created,
-            }
+@ndb.tasklet
+def updates2dicts_async(updates):
+    '''Future of {"obj": post dict, "hash": update time} of updates, each
+    post is loaded and serialized once (updates of deleted posts are
+    dropped)'''
+    keys = uniquify(update.post for update in updates if update.post)
+    posts = [post for post in (yield ndb.get_multi_async(keys)) if post]
+    dicts = yield db.to_dicts_async(posts)
+    post_dicts = dict((post.key, d) for post, d in zip(posts, dicts))
+    raise ndb.Return([
+        {'obj': post_dicts[update.post], 'hash': update.created}
+        for update in updates if update.post in post_dicts])
 
 
 class ChannelsHandler(RequestHandler):
@@ -419,38 +535,109 @@ class ChannelsHandler(RequestHandler):
                 self.abort(httplib.BAD_REQUEST)
         return since, key
 
-    def post2obj(self, post):
+    def post2obj(self, post, post_dict):
         return {
-            'post': post.to_dict(),
+            'post': post_dict,
             'hash': self.encode_hash(post.created, post.key),
         }
 
+    @toplevel
     def get(self, chan_key=None):
-        self.get_user()  # Make sure we're authenticated
+        # Make sure we're authenticated (while we load the channel)
+        user_future = self.get_user_async()
+        chan_future = db.Channel.from_key_async(chan_key) if chan_key else None
+        yield user_future
         if not chan_key:
-            return self.list_channels()
+            self.list_channels()
+            return
 
         # Updates on a channel
-        chan = db.Channel.from_key(chan_key)
+        chan = yield chan_future
         if not chan:
             log.error('unknown channel - %s', chan_key)
             self.abort(httplib.NOT_FOUND)
+        telemetry.record('read.feed', chan.key)
 
         since, key = self.parse_hash()
         count = self.get_param('count', int, 100)
-        objs = [self.post2obj(post) for post in chan.find(since, key, count)]
+        fields = self.fields()
+
+        # Clients polling a channel send the same hash, one of them computes
+        # the page (no hash means the newest page)
+        cache_key = feed_cache_key(
+            chan_key, self.request.get('hash'), count, fields)
+        objs = yield coalesce.get_async(
+            cache_key,
+            lambda: self.load_page_async(chan, since, key, count, fields),
+            feed_ttl)
+
+        # Clients scroll with the hash of the last item, a full page probably
+        # has a next one. One request enqueues the task if it's not cached.
+        if (prefetch_feed or self.request.get('prefetch')) and \
+                objs and len(objs) == abs(count):
+            next_hash = objs[-1]['hash']
+            claimed = yield coalesce.claim_prefetch_async(
+                feed_cache_key(chan_key, next_hash, count, fields))
+            if claimed:
+                task = taskqueue.Task(url=prefetch_feed_task_url, params={
+                    'chan': chan_key,
+                    'hash': next_hash,
+                    'count': count,
+                    'fields': self.request.get('fields'),
+                })
+                yield taskqueue.Queue().add_async(task)
         self.json_reply({'ok': True, 'updates': objs})
 
+    def load_page(self, chan, since, key, count, fields):
+        return self.load_page_async(
+            chan, since, key, count, fields).get_result()
+
+    @ndb.tasklet
+    def load_page_async(self, chan, since, key, count, fields):
+        posts = yield chan.find_async(since, key, count)
+        dicts = yield db.to_dicts_async(posts, fields=fields)
+        raise ndb.Return([self.post2obj(post, post_dict)
+                          for post, post_dict in zip(posts, dicts)])
+
     def list_channels(self):
-        channels = [chan.to_dict() for chan in db.Channel.iter_all()]
+        channels = db.Channel.all_dicts()
         self.json_reply({'ok': True, 'channels': channels})
 
 
+def feed_cache_key(chan_key, hash, count, fields):
+    return coalesce.cache_key(
+        'feed', chan_key, hash, count, sorted(fields) if fields else None)
+
+
+class PrefetchFeedTask(ChannelsHandler):
+    '''Compute a feed page before clients ask for it (see coalesce.prefetch)'''
+    def get(self):
+        self.abort(httplib.METHOD_NOT_ALLOWED)
+
+    def post(self):
+        self.assert_internal('X-Appengine-QueueName')
+        chan_key = self.request.get('chan')
+        chan = db.Channel.from_key(chan_key)
+        if not chan:
+            log.error('unknown channel - %s', chan_key)
+            self.abort(httplib.NOT_FOUND)
+
+        since, key = self.parse_hash()
+        count = self.get_param('count', int, 100)
+        fields = self.fields()
+        cache_key = feed_cache_key(
+            chan_key, self.request.get('hash'), count, fields)
+        prefetched = coalesce.prefetch(
+            cache_key, lambda: self.load_page(chan, since, key, count, fields))
+        self.json_reply({'ok': True, 'prefetched': prefetched})
+
+
 class UpdatesHandler(RequestHandler):
     dbtype = db.Update
 
+    @toplevel
     def get(self):
-        self.get_user()  # Make sure we're authenticated
+        yield self.get_user_async()  # Make sure we're authenticated
 
         keys = self.request.get('key', allow_multiple=True)
 
@@ -474,14 +661,10 @@ class UpdatesHandler(RequestHandler):
                     pass
             keys = new_keys
 
-        if kind:
-            updates = db.Update.updates_for(keys, since, kinds=[kind])
-        else:
-            updates = db.Update.updates_for(keys, since)
-        objs_dicts = (update2dict(update) for update in updates if update.post)
-        objs = sorted(
-            (od for od in objs_dicts if od),
-            key=hashkey)
+        updates = yield db.Update.updates_for_async(
+            keys, since, kinds=[kind] if kind else None)
+        objs = yield updates2dicts_async(updates)
+        objs.sort(key=hashkey)
 
         self.json_reply({'ok': True, 'hash': sample_time, 'updates': objs})
 
@@ -489,8 +672,9 @@ class UpdatesHandler(RequestHandler):
 class ItemsHandler(RequestHandler):
     dbtype = db.Model
 
+    @toplevel
     def get(self):
-        self.get_user()  # Make sure we're authenticated
+        yield self.get_user_async()  # Make sure we're authenticated
 
         keys = self.request.get('key', allow_multiple=True)
 
@@ -498,15 +682,26 @@ class ItemsHandler(RequestHandler):
             log.error('no keys')
             self.abort(httplib.BAD_REQUEST)
 
-        sample_time = datetime.now()
+        fields = self.fields()
+        keys = uniquify(keys)
+        telemetry.record_multi('read.items', keys)
 
-        try:
-            objs = \
-                [obj.to_dict() for obj in db.get_multi(uniquify(keys)) if obj]
-        except TypeError as err:
-            log.error('bad keys - %s', err)
-            self.abort(httplib.BAD_REQUEST)
+        @ndb.tasklet
+        def load_async():
+            sample_time = datetime.now()
+            objs = yield db.get_multi_async(keys)
+            try:
+                objs = yield db.to_dicts_async(
+                    [obj for obj in objs if obj], fields=fields)
+            except TypeError as err:
+                log.error('bad keys - %s', err)
+                self.abort(httplib.BAD_REQUEST)
+            raise ndb.Return((sample_time, objs))
 
+        cache_key = coalesce.cache_key(
+            'items', sorted(keys), sorted(fields) if fields else None)
+        sample_time, objs = yield coalesce.get_async(
+            cache_key, load_async, items_ttl)
         self.json_reply({'ok': True, 'objects': objs, 'hash': sample_time})
 
 
@@ -526,8 +721,18 @@ class FlagHandler(RequestHandler):
             log.error('bad key - %s (%s)', key, err)
             self.abort(httplib.BAD_REQUEST)
 
-        flag = db.Flag.create(key, datetime.now())
-        taskqueue.add(url=flag_task_url, params={'key': key})
+        # Admins get a digest of flagged objects (see FlagDigestTask)
+        now = datetime.now()
+        try:
+            flag = db.Flag.create(key, now)
+        except datastore_errors.TransactionFailedError:
+            # Many flags at once on key, store the flag and count it later
+            log.warning('moderation contended, recount in task - %s', key)
+            flag = db.Flag(created=now, parent=key)
+            flag.put()
+            taskqueue.add(url=recount_flags_task_url,
+                          params={'key': key.urlsafe()},
+                          countdown=recount_flags_delay)
         self.key_reply(flag)
 
 
@@ -547,12 +752,90 @@ class FeedbackHandler(RequestHandler):
         self.key_reply(fb)
 
 
+class BatchHandler(RequestHandler):
+    '''Several GET requests in one.
+
+    The user is authenticated once, sub-requests run concurrently (as
+    tasklets) in one ndb context so entities loaded by one of them come from
+    the context cache for the others. Handlers without a tasklet version
+    (see toplevel) run one at a time.
+    '''
+    @toplevel
+    def post(self):
+        user = yield self.get_user_async()
+        try:
+            subs = self.request_json()['requests']
+            paths = [str(sub['path']) for sub in subs]
+        except (ValueError, TypeError, KeyError) as err:
+            log.error('bad batch - %s', err)
+            self.abort(httplib.BAD_REQUEST)
+
+        if len(paths) > max_batch:
+            log.error('too many requests in batch - %d', len(paths))
+            self.abort(httplib.BAD_REQUEST)
+
+        responses = yield [self.run_get(path, user) for path in paths]
+        self.json_reply({'ok': True, 'responses': responses})
+
+    @ndb.tasklet
+    def run_get(self, path, user):
+        '''Run GET path (relative to api_prefix) with the handler of its route,
+        returns {"status": ..., "body": ...}'''
+        request = webapp2.Request.blank(api_prefix + path)
+        request.environ[batch_user_key] = user
+        response = webapp2.Response()
+        try:
+            route, args, kwargs = wsgi_app.router.match(request)
+            handler = route.handler(request, response)
+            method = getattr(handler, 'get', None)
+            if method is None or isinstance(handler, BatchHandler):
+                handler.abort(httplib.METHOD_NOT_ALLOWED)
+            tasklet = getattr(method, 'tasklet', None)
+            if tasklet:
+                yield tasklet(handler, *args, **kwargs)
+            else:
+                method(*args, **kwargs)
+        except webapp2.exc.HTTPException as err:
+            response.status = err.code
+        except Exception as err:
+            log.exception('error in batch request %s - %s', path, err)
+            response.status = httplib.INTERNAL_SERVER_ERROR
+
+        body = response.body
+        if response.content_type == 'application/json' and body:
+            body = json.loads(body)
+        raise ndb.Return({'status': response.status_int, 'body': body})
+
+
+_icons = []
+
+
+def icons_json():
+    '''icons.json content (read once per instance)'''
+    if not _icons:
+        with open('icons.json') as fo:
+            _icons.append(fo.read())
+    return _icons[0]
+
+
 class IconsHandler(RequestHandler):
     def get(self):
         self.set_json_header()
-        with open('icons.json') as fo:
-            for chunk in iter(lambda: fo.read(1024), ''):
-                self.response.write(chunk)
+        self.response.write(icons_json())
+
+
+class WarmupHandler(RequestHandler):
+    '''Load modules and fill in-process caches before the instance serves'''
+    def get(self):
+        start = time.time()
+        from . import webedit
+        webedit.warmup()
+        icons_json()
+        db.Channel.all_dicts()
+        db.token_secret()
+        elapsed = (time.time() - start) * 1000
+        log.info('warmup done in %.1fms', elapsed)
+        self.json_reply({'ok': True, 'ms': elapsed})
 
 
 class UpdateTask(RequestHandler):
@@ -583,21 +866,54 @@ class UpdateTask(RequestHandler):
                 log.error('error updating %s - %s', chan, err)
 
 
-class FlagTask(RequestHandler):
-    def post(self):
-        self.assert_internal('X-Appengine-QueueName')
-        key = self.request.get('key')
-        if key is None:
-            log.error('no key')
-            self.abort(httplib.BAD_REQUEST)
+class FlagDigestTask(RequestHandler):
+    '''Send one mail with all objects flagged since the last digest (cron)'''
+    def get(self):
+        self.assert_internal('X-Appengine-Cron')
+        mods = db.Moderation.undigested()
+        if not mods:
+            self.json_reply({'ok': True, 'count': 0})
+            return
+
+        lines = []
+        for mod in sorted(mods, key=lambda mod: mod.count, reverse=True):
+            lines.append('{} {} flagged {} times{}'.format(
+                mod.what_kind, db.encode_key(mod.what), mod.count,
+                ' (hidden)' if mod.count >= db.flag_hide_threshold else ''))
 
         sender = 'flag task <flagtask@{}.appspotmail.com>'.format(
             app_identity.get_application_id())
-        subject = '[FLAGGED] {}'.format(key)
-        body = '{} was flagged'.format(key)
+        subject = '[FLAGGED] {} objects'.format(len(mods))
+        body = '\n'.join(lines)
         # FIXME: "to" as configuration
         mail.send_mail(sender, 'flags@insiderr.com', subject, body)
 
+        # Flags added since the query stay undigested for the next digest
+        db.Moderation.mark_digested(mods)
+        self.json_reply({'ok': True, 'count': len(mods)})
+
+
+class FlagTask(RequestHandler):
+    '''Drop per flag mail tasks queued before FlagDigestTask (remove after
+    the next release)'''
+    def post(self):
+        self.assert_internal('X-Appengine-QueueName')
+        log.info('flag mail task dropped (see flag digest) - %s',
+                 self.request.get('key'))
+
+
+class RecountFlagsTask(RequestHandler):
+    '''Count flags stored by FlagHandler without updating Moderation'''
+    def post(self):
+        self.assert_internal('X-Appengine-QueueName')
+        key = db.decode_key_or_none(self.request.get('key'))
+        if not key:
+            log.error('bad key - %s', self.request.get('key'))
+            self.abort(httplib.BAD_REQUEST)
+        # Idempotent, fails (and is retried) while still contended
+        mapper.backfill_moderation(key)
+        self.json_reply({'ok': True})
+
 
 class FeedbackTask(RequestHandler):
     def post(self):
@@ -617,6 +933,173 @@ class FeedbackTask(RequestHandler):
         mail.send_mail(sender, 'feedback@insiderr.com', subject, body)
 
 
+class CompactUpdatesTask(RequestHandler):
+    '''Delete old updates, keeping newest per (post, what_kind).
+
+    Started daily by cron (GET), each task handles one batch and chains the
+    next one with the cursor and running totals.
+    '''
+    def get(self):
+        self.assert_internal('X-Appengine-Cron')
+        before = datetime.now() - db.update_retention
+        taskqueue.add(url=compact_task_url,
+                      params={'before': before.strftime(time_fmt)})
+        self.json_reply({'ok': True, 'before': before})
+
+    def post(self):
+        self.assert_internal('X-Appengine-QueueName')
+        before = self.get_param('before', str2dt, None)
+        if not before:
+            log.error('no before time')
+            self.abort(httplib.BAD_REQUEST)
+
+        cur = self.request.get('cur') or None
+        total = self.get_param('deleted', int, 0)
+        batches = self.get_param('batches', int, 0) + 1
+
+        deleted, cur, more = db.Update.compact(before, cur)
+        total += deleted
+        if more and cur:
+            taskqueue.add(url=compact_task_url, params={
+                'before': before.strftime(time_fmt),
+                'cur': cur,
+                'deleted': total,
+                'batches': batches,
+            })
+        else:
+            per_row = db.index_entries(
+                db.Update, db.update_composite_indexes)
+            log.info(
+                'update compaction done (before %s): %d batches, %d rows and '
+                '~%d index entries reclaimed',
+                before, batches, total, total * per_row)
+
+        self.json_reply({
+            'ok': True,
+            'deleted': deleted,
+            'total': total,
+            'done': not (more and cur),
+        })
+
+
+class CascadeDeleteTask(RequestHandler):
+    '''Delete one batch of a cascade delete job and chain the next one'''
+    def post(self):
+        self.assert_internal('X-Appengine-QueueName')
+        job = db.decode_key_or_none(self.request.get('job'))
+        job = job.get() if job else None
+        if not job:
+            log.error('unknown job - %s', self.request.get('job'))
+            self.abort(httplib.BAD_REQUEST)
+
+        if job.done:
+            log.warning('job already done - %s', job.key.urlsafe())
+            return
+
+        count, cur, more = db.cascade_delete_batch(
+            job.target, job.stage, job.cursor)
+        job.advance(count, cur, more, db.cascade_stages)
+        save_job(job, cascade_delete_task_url)
+        if job.done:
+            log.info('cascade delete of %s done, %d objects deleted',
+                     job.target, job.processed)
+
+
+class MapperTask(RequestHandler):
+    '''Run one batch of a mapper job and chain the next one'''
+    def post(self):
+        self.assert_internal('X-Appengine-QueueName')
+        job = db.decode_key_or_none(self.request.get('job'))
+        job = job.get() if job else None
+        if not job:
+            log.error('unknown job - %s', self.request.get('job'))
+            self.abort(httplib.BAD_REQUEST)
+
+        if job.done:
+            log.warning('job already done - %s', job.key.urlsafe())
+            return
+
+        mpr = mapper.get_mapper(job.name)
+        if not mpr:
+            log.error('unknown mapper - %s', job.name)
+            self.abort(httplib.BAD_REQUEST)
+
+        start = time.time()
+        count, changed, cur, more = mpr.run_batch(job.cursor)
+        job.elapsed += time.time() - start
+        job.changed += changed
+        job.advance(count, cur, more)
+        save_job(job, mapper_task_url)
+        if job.done:
+            log.info('mapper %s done: %d processed, %d changed in %.1fsec',
+                     job.name, job.processed, job.changed, job.elapsed)
+
+
+class PurgeRepliesTask(RequestHandler):
+    '''Delete stored idempotent replies older than the retry window (cron)'''
+    def get(self):
+        self.assert_internal('X-Appengine-Cron')
+        job = start_mapper('purge-replies')
+        self.json_reply({'ok': True, 'job': job.key})
+
+
+class PublishTask(RequestHandler):
+    '''Publish due scheduled posts and comments (cron GET, POST when more
+    than a batch is due)'''
+    def get(self):
+        self.assert_internal('X-Appengine-Cron')
+        self.publish_due()
+
+    def post(self):
+        self.assert_internal('X-Appengine-QueueName')
+        self.publish_due()
+
+    def publish_due(self):
+        entries, more = db.Pending.due()
+        published = [obj for obj in (publish(entry.key) for entry in entries)
+                     if obj]
+        if more:
+            taskqueue.add(url=publish_task_url)
+        if published:
+            log.info('published %d scheduled objects', len(published))
+        self.json_reply({'ok': True, 'published': len(published)})
+
+
+class ImportTask(RequestHandler):
+    '''Import one chunk of an import job and chain the next one'''
+    def post(self):
+        from . import webedit
+
+        self.assert_internal('X-Appengine-QueueName')
+        job = db.decode_key_or_none(self.request.get('job'))
+        job = job.get() if job else None
+        if not job:
+            log.error('unknown job - %s', self.request.get('job'))
+            self.abort(httplib.BAD_REQUEST)
+
+        if job.done:
+            log.warning('job already done - %s', job.key.urlsafe())
+            return
+
+        chunk, items = bulk.next_chunk(job.key)
+        if chunk:
+            start = time.time()
+            channel = db.encode_key(job.target) if job.target else None
+            # Retries of the chunk overwrite the same keys
+            name = '{}-{}'.format(job.key.id(), chunk.key.id())
+            count = bulk.import_items(
+                items, webedit.cached_edit_users(), webedit.edit_str2dt,
+                channel, name)
+            job.elapsed += time.time() - start
+            job.changed += count
+            job.processed += len(items)
+        job.done = chunk is None
+        save_job(job, import_task_url, [chunk.key] if chunk else [])
+        if job.done:
+            log.info('import done: %d posts in %.1fsec',
+                     job.processed, job.elapsed)
+
+
 api_prefix = '/api/v1'
 routes = []
 #from datetime import datetime
@@ -629,17 +1112,30 @@ if True: #(datetime.now() < d):
         (api_prefix + '/posts/(.*)', PostsHandler),
         (api_prefix + '/comments/(.*)', CommentsHandler),
         (api_prefix + '/votes/(.*)/(.*)', VotesHandler),
+        (api_prefix + '/myvotes/', MyVotesHandler),
         (api_prefix + '/channels/(.*)', ChannelsHandler),
         (api_prefix + '/updates/', UpdatesHandler),
         (api_prefix + '/items/', ItemsHandler),
         (api_prefix + '/flag/(.*)', FlagHandler),
         (api_prefix + '/icons', IconsHandler),
         (api_prefix + '/feedbacks/', FeedbackHandler),
+        (api_prefix + '/batch/?', BatchHandler),
+
+        ('/_ah/warmup', WarmupHandler),
 
         # Tasks
         (update_task_url, UpdateTask),
+        (flag_digest_task_url, FlagDigestTask),
         (flag_task_url, FlagTask),
+        (recount_flags_task_url, RecountFlagsTask),
         (feedback_task_url, FeedbackTask),
+        (compact_task_url, CompactUpdatesTask),
+        (cascade_delete_task_url, CascadeDeleteTask),
+        (mapper_task_url, MapperTask),
+        (purge_replies_task_url, PurgeRepliesTask),
+        (import_task_url, ImportTask),
+        (publish_task_url, PublishTask),
+        (prefetch_feed_task_url, PrefetchFeedTask),
     ]
 
 # FIXME: Find a better way, I hate test code going into production
@@ -654,4 +1150,5 @@ if is_local_srv():
     routes += [(api_prefix + '/_t/channel/(.*)', TestChannelHandler)]
 
 
-app = webapp2.WSGIApplication(routes, debug=is_local_srv())
+wsgi_app = webapp2.WSGIApplication(routes, debug=is_local_srv())
+app = profiling.ProfileMiddleware(wsgi_app, local=is_local_srv())
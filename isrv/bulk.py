@@ -0,0 +1,251 @@
+'''Bulk import and export of posts for editors.
+
+The format is NDJSON, one post per line with its comments nested:
+
+    {"content": ..., "theme": ..., "background": ..., "role": ...,
+     "role_text": ..., "channels": [<channel key>], "created": <time>,
+     "user": <edit user key>, "upvote_count": 3, "downvote_count": 1,
+     "comments": [{"content": ..., "role": ..., "role_text": ...,
+                   "created": <time>, "user": <edit user key>,
+                   "upvote_count": 0, "downvote_count": 0}, ...]}
+
+channels, created, user, counts and comments are optional. Export writes the
+same format (plus keys and comment_count) so an export can be imported. Lines
+are validated on upload (types, counts up to max_votes) so a bad line is
+rejected with its number instead of failing the import task.
+
+Imports are split to chunks stored as ImportChunk entities under the import
+job, each chunk is written with a few put_multi calls (posts, then comments and
+post users, then votes) by a chained task (see api.ImportTask). Imported
+entities get key names from the chunk and line, so a retried chunk overwrites
+what it wrote before instead of duplicating it. Posts and comments with a
+future created time are scheduled (see db.Pending).
+'''
+from . import db
+
+from itertools import cycle
+import json
+
+post_fields = ['content', 'theme', 'background', 'role', 'role_text']
+comment_fields = ['content', 'role', 'role_text']
+chunk_size = 50  # Posts per import chunk
+max_votes = 1000  # Up/down votes per imported post or comment
+count_fields = ['upvote_count', 'downvote_count']
+
+
+class ImportChunk(db.Model):
+    '''Posts (NDJSON) waiting to be imported, child of the import job'''
+    data = db.ndb.TextProperty()
+
+
+def _bad_channels(item, channels):
+    names = item.get('channels') or [item.get('channel')]
+    if not isinstance(names, list):
+        return [names]
+    bad = []
+    for name in names:
+        if name is None:
+            continue
+        key = db.decode_key_or_none(name) if isinstance(name, basestring) \
+            else None
+        if not key or key.kind() != 'Channel' or \
+                (channels is not None and name not in channels):
+            bad.append(name)
+    return bad
+
+
+def _bad_fields(item, fields, prefix=''):
+    '''Names of fields of item with bad values (with prefix)'''
+    bad = [name for name in fields if not isinstance(item[name], basestring)]
+    bad.extend(
+        name for name in ['created', 'user']
+        if item.get(name) is not None and
+        not isinstance(item[name], basestring))
+    for name in count_fields:
+        count = item.get(name, 0)
+        if isinstance(count, bool) or not isinstance(count, (int, long)) or \
+                not 0 <= count <= max_votes:
+            bad.append(name)
+    return [prefix + name for name in bad]
+
+
+def parse_lines(lines, channels=None):
+    '''Parse and validate NDJSON lines, raises ValueError on bad line.
+    channels is the set of existing channel keys (not checked if None).'''
+    items = []
+    for num, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as err:
+            raise ValueError('line {}: {}'.format(num, err))
+        comments = item.get('comments', []) if isinstance(item, dict) \
+            else None
+        if not isinstance(comments, list) or \
+                not all(isinstance(comment, dict) for comment in comments):
+            raise ValueError('line {}: not a post object'.format(num))
+        missing = [name for name in post_fields if name not in item]
+        for comment in comments:
+            missing.extend(
+                'comments.' + name
+                for name in comment_fields if name not in comment)
+        if missing:
+            raise ValueError('line {}: missing {}'.format(
+                num, ', '.join(sorted(set(missing)))))
+        bad = _bad_fields(item, post_fields)
+        for comment in comments:
+            bad.extend(_bad_fields(comment, comment_fields, 'comments.'))
+        if bad:
+            raise ValueError('line {}: bad {}'.format(
+                num, ', '.join(sorted(set(bad)))))
+        bad = _bad_channels(item, channels)
+        if bad:
+            raise ValueError('line {}: bad channel {}'.format(
+                num, ', '.join(str(name) for name in bad)))
+        items.append(item)
+    return items
+
+
+def stage_import(job, items):
+    '''Store items in chunks under job'''
+    chunks = [
+        ImportChunk(
+            parent=job.key,
+            data='\n'.join(json.dumps(item) for item in items[i:i+chunk_size]),
+        )
+        for i in xrange(0, len(items), chunk_size)
+    ]
+    db.ndb.put_multi(chunks)
+    return len(chunks)
+
+
+def next_chunk(job_key):
+    '''Next chunk to import (None if done), returns (chunk, items)'''
+    chunk = ImportChunk.query(ancestor=job_key).get()
+    if not chunk:
+        return None, []
+    return chunk, [json.loads(line) for line in chunk.data.splitlines()]
+
+
+def _user_for(item, users, default):
+    user = item.get('user')
+    for u in users:
+        if db.encode_key(u.key) == user:
+            return u
+    return default
+
+
+def _votes(obj, uid, item):
+    return (
+        [db.UpVote(id='up-{}'.format(i), user=uid, parent=obj.key)
+         for i in xrange(int(item.get('upvote_count', 0)))] +
+        [db.DownVote(id='down-{}'.format(i), user=uid, parent=obj.key)
+         for i in xrange(int(item.get('downvote_count', 0)))])
+
+
+def import_items(items, users, parse_time, default_channel=None,
+                 name='import'):
+    '''Create posts (with comments and votes) in items, users are the edit
+    users, parse_time converts "created" strings to datetime. Key names start
+    with name (unique per chunk), importing the same items again overwrites
+    them. Returns number of posts created.'''
+    if not items:
+        return 0
+
+    commenters = cycle(users)
+    posts = []
+    for num, item in enumerate(items):
+        channels = item.get('channels') or [item.get('channel')]
+        channels = [chan for chan in channels if chan] or \
+            ([default_channel] if default_channel else [])
+        user = _user_for(item, users, users[0])
+        post = db.Post(
+            id='{}-{}'.format(name, num),
+            parent=user.key,
+            channels=channels,
+            **dict((name, item[name]) for name in post_fields))
+        created = item.get('created') and parse_time(item['created'])
+        if created:
+            post.created = created
+        post.update_published()
+        posts.append(post)
+    db.ndb.put_multi(posts)
+
+    objs, others = [], []  # others are post votes and PostUsers
+    for post, item in zip(posts, items):
+        uid_map = db.PostUsers.initial_map(post)
+        others.extend(_votes(post, 0, item))
+        for num, data in enumerate(item.get('comments', [])):
+            user = _user_for(data, users, next(commenters))
+            uid = uid_map.get(user.uid())
+            if uid is None:
+                uid = db.new_random_uid(set(uid_map.itervalues()))
+                uid_map[user.uid()] = uid
+            comment = db.Comment(
+                id='c-{}'.format(num),
+                parent=post.key,
+                user=uid,
+                **dict((name, data[name]) for name in comment_fields))
+            created = data.get('created') and parse_time(data['created'])
+            if created:
+                comment.created = created
+            comment.update_published()
+            objs.append((comment, data))
+        others.append(db.PostUsers(
+            key=db.PostUsers.key_for(post.key), uid_map=uid_map))
+
+    comments = [obj for obj, _ in objs]
+    db.ndb.put_multi(comments + others)
+    # Future dated posts and comments are published by api.PublishTask
+    db.schedule(posts + comments)
+    votes = []
+    for comment, data in objs:
+        votes.extend(_votes(comment, comment.user, data))
+    db.ndb.put_multi(votes)
+    return len(posts)
+
+
+def export_page(cursor=None, count=100):
+    '''Page of posts (newest first) with nested comments as dicts.
+
+    Returns (dicts, cursor, more)
+    '''
+    cursor = db.ndb.Cursor(urlsafe=cursor) if cursor else None
+    query = db.Post.query().order(-db.Post.created)
+    posts, cursor, more = query.fetch_page(count, start_cursor=cursor)
+
+    comment_futures = [
+        post.comments_query(include_future=True).fetch_async()
+        for post in posts]
+    post_dicts = db.to_dicts(posts, include_future=True)
+    comments = [future.get_result() for future in comment_futures]
+    comment_dicts = db.to_dicts(
+        [comment for post_comments in comments for comment in post_comments],
+        include_future=True)
+
+    users = {}  # post key -> {post uid: user key}
+    pusers = db.ndb.get_multi(
+        [db.PostUsers.key_for(post.key) for post in posts])
+    for post, post_users in zip(posts, pusers):
+        if post_users:
+            uid_map = post_users.uid_map
+        else:
+            uid_map = db.PostUsers.initial_map(post)
+        users[post.key] = dict((v, k) for k, v in uid_map.iteritems())
+
+    start = 0
+    for post, post_dict, post_comments in zip(posts, post_dicts, comments):
+        post_dict['user'] = db.encode_key(post.key.parent())
+        post_dict['channels'] = post.all_channels()
+        end = start + len(post_comments)
+        post_dict['comments'] = comment_dicts[start:end]
+        for comment, comment_dict in zip(post_comments, post_dict['comments']):
+            comment_dict['user'] = users[post.key].get(comment.user)
+            # Post vote counts include votes on its comments
+            for name in ('upvote_count', 'downvote_count'):
+                post_dict[name] -= comment_dict[name]
+        start = end
+
+    return post_dicts, cursor.urlsafe() if cursor else None, more
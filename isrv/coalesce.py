@@ -0,0 +1,149 @@
+'''Cached reads with stampede protection.
+
+Values are kept in memcache with the time they were computed. A fresh value is
+returned as is. When it's missing or stale one request (across instances)
+takes a short memcache.add lock and recomputes, other requests get the stale
+value, or (when there's none) wait a bit for the new one before computing it
+themselves. Threads of an instance coalesce on the same memcache lock, waiting
+never blocks the thread (it's an ndb.sleep).
+
+get_async is the tasklet version (memcache calls are batched by the ndb
+context), so handlers run by api.BatchHandler don't block each other. Tasklets
+of a thread asking for the same key share one future. Futures belong to the
+event loop of their thread, so they're not shared across threads.
+
+A value can be prefetched (e.g. the next feed page, computed in a task before
+clients ask for it), it's kept for prefetch_ttl seconds and used by get
+instead of calling load, with the time it was computed. claim_prefetch_async
+lets one request schedule the prefetch of a value that isn't cached yet.
+'''
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import eventloop
+
+from hashlib import sha1
+import logging as log
+import threading
+import time
+
+key_prefix = 'coalesce:'
+lock_prefix = key_prefix + 'lock:'
+prefetch_prefix = key_prefix + 'prefetch:'
+claim_prefix = key_prefix + 'claim:'
+# Longer than computing a value, expires locks of crashed requests
+lock_ttl = 10
+# How long to wait for a value computed by another request (seconds)
+wait_timeout = 2
+poll_interval = 0.05
+prefetch_ttl = 30
+
+# .futures: key -> future of get_async, of the .loop event loop
+_local = threading.local()
+
+
+def _futures():
+    '''Futures of get_async of this thread, each request has a new event loop
+    (futures of a failed request may never finish)'''
+    loop = eventloop.get_event_loop()
+    if getattr(_local, 'loop', None) is not loop:
+        _local.loop, _local.futures = loop, {}
+    return _local.futures
+
+
+def _done(futures, key, future):
+    if futures.get(key) is future:
+        del futures[key]
+
+
+def cache_key(*parts):
+    return key_prefix + sha1(
+        '\n'.join(str(part) for part in parts)).hexdigest()
+
+
+@ndb.tasklet
+def _wait_async(key):
+    ctx = ndb.get_context()
+    deadline = time.time() + wait_timeout
+    while time.time() < deadline:
+        yield ndb.sleep(poll_interval)
+        cached = yield ctx.memcache_get(key)
+        if cached:
+            raise ndb.Return(cached)
+    raise ndb.Return(None)
+
+
+def get(key, load, ttl, stale_ttl=60):
+    '''Value of key (see cache_key), load() computes it. Values are fresh for
+    ttl seconds and served while recomputed for another stale_ttl.'''
+    @ndb.tasklet
+    def load_async():
+        raise ndb.Return(load())
+
+    return get_async(key, load_async, ttl, stale_ttl).get_result()
+
+
+def get_async(key, load_async, ttl, stale_ttl=60):
+    '''Future of the value of key, load_async() returns a future of the value
+    (see get)'''
+    futures = _futures()
+    future = futures.get(key)
+    # _done runs later, when the event loop runs again
+    if future is None or future.done():
+        future = futures[key] = _get_async(key, load_async, ttl, stale_ttl)
+        future.add_callback(_done, futures, key, future)
+    return future
+
+
+@ndb.tasklet
+def _get_async(key, load_async, ttl, stale_ttl):
+    ctx = ndb.get_context()
+    # Prefetched value comes with the same batch
+    cached, prefetched = yield (
+        ctx.memcache_get(key), ctx.memcache_get(prefetch_prefix + key))
+    if cached and time.time() - cached[0] < ttl:
+        raise ndb.Return(cached[1])
+
+    locked = yield ctx.memcache_add(lock_prefix + key, 1, lock_ttl)
+    if not locked:
+        # Someone else is computing
+        if cached:
+            raise ndb.Return(cached[1])
+        cached = yield _wait_async(key)
+        if cached:
+            raise ndb.Return(cached[1])
+        log.warning('timeout waiting for %s, computing', key)
+
+    try:
+        if prefetched is not None:
+            # Keep the time it was computed, it's fresh for less than ttl
+            computed, value = prefetched
+            yield ctx.memcache_delete(prefetch_prefix + key)
+        else:
+            value = yield load_async()
+            computed = time.time()
+        yield ctx.memcache_set(key, (computed, value), ttl + stale_ttl)
+    finally:
+        if locked:
+            yield ctx.memcache_delete(lock_prefix + key)
+    raise ndb.Return(value)
+
+
+def prefetch(key, load, ttl=prefetch_ttl):
+    '''Compute value of key ahead of get, returns False if it's already
+    prefetched'''
+    if memcache.get(prefetch_prefix + key) is not None:
+        return False
+    return memcache.add(prefetch_prefix + key, (time.time(), load()), ttl)
+
+
+@ndb.tasklet
+def claim_prefetch_async(key, ttl=prefetch_ttl):
+    '''Future of True if the caller should prefetch key, it's not cached or
+    prefetched and no request claimed it in the last ttl seconds'''
+    ctx = ndb.get_context()
+    cached, prefetched = yield (
+        ctx.memcache_get(key), ctx.memcache_get(prefetch_prefix + key))
+    if cached or prefetched is not None:
+        raise ndb.Return(False)
+    claimed = yield ctx.memcache_add(claim_prefix + key, 1, ttl)
+    raise ndb.Return(claimed)
@@ -2,9 +2,14 @@
 # DB Ancestry
 .
 |-- Channel
+|-- Job
+|-- Moderation
+|-- Pending
+|-- TokenSecret
 |-- Update
 `-- User
     |-- Post
+    |   |-- PostUsers
     |   |-- Comment
     |   |   |-- Flag
     |   |   |-- DownVote
@@ -14,26 +19,97 @@
     |   `-- UpVote
     `-- Token
 
+# Session Tokens
+Session tokens are signed (HMAC) and carry the user key, issue time and the
+user token epoch: "<user key>.<issued>.<epoch>.<signature>". Checking one
+costs no datastore RPC, the user epoch is cached (in process and memcache) and
+login increments it, which revokes all older tokens of the user. A token with
+an epoch newer than the cached one (login on another instance) reloads it.
+
+Legacy tokens (urlsafe key of a Token child of the user) are accepted while
+accept_legacy_tokens is set, until the user logs in again.
+
 # Post Users
 
 Users in post are different from users in the database. Each post has uid_map
 which maps user id to post user id. The initial user is 0. Comments and Votes
 users are the post user id.
 
+The uid_map is kept in a PostUsers child of the post (and not on the post
+itself) so feed reads don't load it and votes/comments don't rewrite the post.
+PostUsers is created on the first post_user call, older posts which still have
+uid_map on the Post entity are migrated at this point.
+
 # Updates
 We keep a list of updates per channel. Each update has time and object that was
 changed.
+
+Updates are indexed by sort, "<shard>|<created>" with a random shard out of
+update_shards (created is not indexed). A burst of updates, which all have
+about the same created time, is written to update_shards index ranges instead
+of the tail of one. Readers query each shard and merge by created. Updates
+written before sort was added get one when re-put (mapper reput-Update).
+
+# Scheduled publishing
+Posts and comments can be created in the future (by editors). These are not
+published until their created time: an unpublished post has no channels (they
+are kept in scheduled_channels) so it's not in any feed, unpublished comments
+are filtered out by Comment.published. Each one has a Pending entry, a periodic
+task (api.PublishTask) publishes due entries and notifies their channels.
+
+Entities written before scheduling have no indexed published and future posts
+still have their channels. Until the schedule-* mappers ran and
+publishing_migrated is set, feeds and comments filter on created time as well.
+
+# Flags
+Each flag is a Flag child of the flagged object, Moderation (key name is the
+flagged object key) keeps the flag count and is the moderation queue. Objects
+flagged flag_hide_threshold times are marked hidden and not shown in feeds.
+When Moderation is contended (many flags at once) the flag is stored alone and
+counted by a task (api.RecountFlagsTask).
 '''
+from . import telemetry
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+from base64 import urlsafe_b64encode
 from crypt import crypt
+from hashlib import sha256
+from operator import attrgetter
 from random import randint
+import hmac
 import logging as log
-from datetime import datetime
+import os
+from datetime import datetime, timedelta
+from time import time
 
 # Generate with crypt.mksalt(crypt.METHOD_SHA512)
 _salt = '$6$/8uVjwsTUDgiFkDt'
 
+time_fmt = '%Y-%m-%dT%H:%M:%SZ'
+
+# Updates older than this are compacted (see Update.compact)
+update_retention = timedelta(days=7)
+# Number of Update sort shards, changing it requires re-putting updates
+update_shards = 4
+sort_time_fmt = '%Y-%m-%dT%H:%M:%S.%f'
+# Update composite indexes in index.yaml (see index_entries, checked by tests)
+update_composite_indexes = 2
+# Flags on an object until it's hidden from feeds
+flag_hide_threshold = 5
+# Set once the schedule-Post and schedule-Comment mappers ran (see
+# mapper.SchedulePublishing), until then queries also filter on created time
+publishing_migrated = False
+# Set when the key-UpVote/key-DownVote mappers ran, my_votes_async then looks
+# up votes by key only (no queries for votes with auto ids)
+votes_keyed = False
+# Accept Token entity keys as session tokens (see User.from_token_async)
+accept_legacy_tokens = True
+token_max_age = timedelta(days=365)
+epoch_key_prefix = 'token-epoch:'
+
 
 KeyType = ndb.Key
 
@@ -60,10 +136,94 @@ def decode_key_or_none(key):
     except:
         return None
 
+
 def encode_key(key):
     return key.urlsafe()
 
 
+def encode_time(time):
+    return time.strftime(time_fmt)
+
+
+def _value_encoder(prop):
+    '''Return function encoding a value of prop to JSON friendly value.'''
+    if isinstance(prop, ndb.KeyProperty):
+        enc = encode_key
+    elif isinstance(prop, ndb.DateTimeProperty):
+        enc = encode_time
+    else:
+        return None
+
+    if prop._repeated:
+        return lambda values: [enc(value) for value in values]
+    return enc
+
+
+class Serializer(object):
+    '''Compiled JSON serializer for a model class.
+
+    Reads only the json_attrs properties of an entity (so heavy properties like
+    Post.uid_map are never unpickled), applies json_conv renames and encodes
+    keys and datetimes to strings.
+    '''
+    def __init__(self, cls):
+        self.fields = []
+        for name in sorted(cls.json_attrs):
+            prop = cls._properties.get(name)
+            if prop is None:
+                continue
+            out_name = cls.json_conv.get(name, name)
+            self.fields.append((name, out_name, _value_encoder(prop)))
+
+    def __call__(self, obj, fields=None):
+        out = {}
+        for name, out_name, enc in self.fields:
+            if fields is not None and out_name not in fields:
+                continue
+            value = getattr(obj, name)
+            if enc and value is not None:
+                value = enc(value)
+            out[out_name] = value
+        out['key'] = encode_key(obj.key)
+        return out
+
+
+_serializers = {}
+
+
+def serializer_for(cls):
+    serializer = _serializers.get(cls)
+    if serializer is None:
+        serializer = _serializers[cls] = Serializer(cls)
+    return serializer
+
+
+def wants(fields, name):
+    '''Return True if name is in requested fields (None means all).'''
+    return fields is None or name in fields
+
+
+def to_dicts(objs, include_future=False, fields=None):
+    '''JSON dicts of objs, count queries of all objects run concurrently'''
+    return to_dicts_async(objs, include_future, fields).get_result()
+
+
+@ndb.tasklet
+def to_dicts_async(objs, include_future=False, fields=None):
+    '''Future of to_dicts'''
+    futures = [obj.counts_async(include_future, fields) for obj in objs]
+    dicts = []
+    for obj, obj_futures in zip(objs, futures):
+        obj_dict = serializer_for(type(obj))(obj, fields)
+        names = obj_futures.keys()
+        counts = yield [obj_futures[name] for name in names]
+        obj_dict.update(zip(names, counts))
+        dicts.append(obj_dict)
+    raise ndb.Return(dicts)
+
+
+# NOTE: Properties which are not queried are indexed=False, see
+# misc/index_audit.py before adding a query on one of them
 class Model(ndb.Model):
     # TODO: Not happy that model knows about representation, think about how to
     # do this code better
@@ -72,54 +232,208 @@ class Model(ndb.Model):
 
     @staticmethod
     def from_key(key):
-        key = decode_key(key)
-        return key.get()
+        return Model.from_key_async(key).get_result()
 
-    def to_dict(self, include_future=False):
-        orig = super(Model, self).to_dict()
+    @staticmethod
+    def from_key_async(key):
+        return decode_key(key).get_async()
 
-        obj = {
-            self.json_conv.get(key, key): orig[key]
-            for key in self.json_attrs if key in orig
-        }
-        obj['key'] = encode_key(self.key)
-        return obj
+    def counts_async(self, include_future=False, fields=None):
+        '''Futures of computed fields (counts) as name -> future'''
+        return {}
+
+    def to_dict(self, include_future=False, fields=None):
+        '''JSON dict of object, fields is set of fields to return (None=all)'''
+        return to_dicts([self], include_future, fields)[0]
 
     @classmethod
     def delete_multi(cls, ancestor_key):
         ndb.delete_multi(cls.query(ancestor=ancestor_key).iter(keys_only=True))
 
 
+class LocalCache(object):
+    '''In-process cache with expiry, shared by the request threads of an
+    instance. Values should not be mutated by callers.'''
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.values = {}  # key -> (expires, value)
+
+    def get(self, key, load):
+        '''Cached value of key, calling load() to create it if missing'''
+        now = time()
+        expires, value = self.values.get(key, (0, None))
+        if expires < now:
+            value = load()
+            self.values[key] = (now + self.ttl, value)
+        return value
+
+    def peek(self, key, default=None):
+        '''Cached value of key (default if missing or expired)'''
+        expires, value = self.values.get(key, (0, default))
+        return value if expires >= time() else default
+
+    def put(self, key, value):
+        self.values[key] = (time() + self.ttl, value)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.values.clear()
+        else:
+            self.values.pop(key, None)
+
+
 class Token(Model):
-    '''Access tokens are stored as children of the user.
+    '''Legacy access tokens are stored as children of the user.
 
     We use the token object key value as the token, so no attributes.
     '''
 
 
+class TokenSecret(Model):
+    '''Session tokens HMAC secret (single entity, created on first use)'''
+    secret = ndb.BlobProperty()
+
+
+_token_secret = []
+
+
+def token_secret():
+    '''HMAC secret of session tokens (read once per instance)'''
+    if not _token_secret:
+        obj = TokenSecret.get_or_insert('hmac', secret=os.urandom(32))
+        _token_secret.append(obj.secret)
+    return _token_secret[0]
+
+
+def sign(payload):
+    digest = hmac.new(token_secret(), payload, sha256).digest()
+    return urlsafe_b64encode(digest).rstrip('=')
+
+
+def same_digest(a, b):
+    '''Constant time string compare'''
+    if len(a) != len(b):
+        return False
+    return sum(ord(x) ^ ord(y) for x, y in zip(a, b)) == 0
+
+
+def make_token(user_key, epoch, issued=None):
+    payload = '{}.{}.{}'.format(
+        user_key.urlsafe(), int(issued or time()), epoch)
+    return '{}.{}'.format(payload, sign(payload))
+
+
+def parse_token(token):
+    '''(user key, issued, epoch) of valid signed token, None otherwise'''
+    try:
+        payload, signature = str(token).rsplit('.', 1)
+        user, issued, epoch = payload.split('.')
+        issued, epoch = int(issued), int(epoch)
+    except (ValueError, UnicodeError):
+        return None
+
+    if not same_digest(sign(payload), signature):
+        return None
+    if time() - issued > token_max_age.total_seconds():
+        return None
+    key = decode_key_or_none(user)
+    if not key or key.kind() != 'User':
+        return None
+    return key, issued, epoch
+
+
+@ndb.tasklet
+def _load_token_epoch_async(user_key, newer=None):
+    ctx = ndb.get_context()
+    mkey = epoch_key_prefix + user_key.urlsafe()
+    epoch = yield ctx.memcache_get(mkey)
+    # Memcache can miss the login set, the user entity has the epoch
+    if epoch is None or (newer is not None and epoch < newer):
+        user = yield user_key.get_async()
+        if not user:
+            raise ndb.Return(None)
+        epoch = user.token_epoch
+        yield ctx.memcache_set(mkey, epoch)
+    raise ndb.Return(epoch)
+
+
+@ndb.tasklet
+def token_epoch_async(user_key, newer=None):
+    '''Future of token epoch of user (None if there's no such user), the
+    cached epoch is reloaded if newer (epoch of a token) is above it'''
+    epoch = User.epoch_cache.peek(user_key)
+    if epoch is None or (newer is not None and epoch < newer):
+        epoch = yield _load_token_epoch_async(user_key, newer)
+        User.epoch_cache.put(user_key, epoch)
+    raise ndb.Return(epoch)
+
+
+@ndb.transactional
+def _next_token_epoch(user_key):
+    user = user_key.get()
+    user.token_epoch += 1
+    user.put()
+    return user.token_epoch
+
+
+class SessionUser(object):
+    '''Authenticated user, only the key is loaded (key.get() for the User)'''
+    def __init__(self, key):
+        self.key = key
+
+    def uid(self):
+        return encode_key(self.key)
+
+
 def hash_pub_key(pub_key):
     return crypt(pub_key, _salt)
 
 
 class User(Model):
     pub_key = ndb.StringProperty()  # Public key hash
-    description = ndb.StringProperty() # Custom user description
+    # Custom user description
+    description = ndb.StringProperty(indexed=False)
     # List of channels this user is subscribed to
-    channels = ndb.StringProperty(repeated=True)
+    channels = ndb.StringProperty(repeated=True, indexed=False)
+    # Session tokens with a lower epoch are revoked
+    token_epoch = ndb.IntegerProperty(default=0, indexed=False)
+
+    # Other instances see a new epoch (revoked tokens) after ttl
+    epoch_cache = LocalCache(ttl=30)
 
     @staticmethod
     def from_token(token):
-        key = decode_key(token)
-        parent = key.parent()
+        return User.from_token_async(token).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def from_token_async(token):
+        '''SessionUser of token (None if not valid)'''
+        if '.' in token:
+            parsed = parse_token(token)
+            if not parsed:
+                log.error('bad token - %s', token)
+                raise ndb.Return(None)
+            key, _, epoch = parsed
+            current = yield token_epoch_async(key, epoch)
+            # Tokens of older logins are revoked
+            if current is None or epoch < current:
+                log.error('revoked token - %s', token)
+                raise ndb.Return(None)
+            raise ndb.Return(SessionUser(key))
+
+        if not accept_legacy_tokens:
+            raise ndb.Return(None)
+        key = decode_key_or_none(token)
+        parent = key.parent() if key else None
         if not parent:
             log.error('token with no parent - %s', token)
-            return None
-        return parent.get()
-
-    def del_tokens(self):
-        # Delete old tokens
-        query = Token.query(ancestor=self.key)
-        ndb.delete_multi(query.iter(keys_only=True))
+            raise ndb.Return(None)
+        # Legacy tokens are revoked on the first login with signed tokens
+        epoch = yield token_epoch_async(parent)
+        if epoch != 0:
+            raise ndb.Return(None)
+        raise ndb.Return(SessionUser(parent))
 
     @staticmethod
     def from_pub_key(pub_key, use_hash=True):
@@ -131,10 +445,11 @@ class User(Model):
         return query.get()
 
     def login(self):
-        self.del_tokens()
-        token = Token(parent=self.key)
-        token.put()
-        return encode_key(token.key)
+        '''New session token, older tokens of the user are revoked'''
+        self.token_epoch = _next_token_epoch(self.key)
+        memcache.set(epoch_key_prefix + self.key.urlsafe(), self.token_epoch)
+        User.epoch_cache.invalidate(self.key)
+        return make_token(self.key, self.token_epoch)
 
     @staticmethod
     def create(pub_key, description=None, use_hash=True):
@@ -155,47 +470,75 @@ class User(Model):
         return encode_key(self.key)
 
 
-def ilen(it):
-    '''Length of iterable.
-
-    Note: This consumes the iterable.
-    '''
-    return sum(1 for _ in it)
+def index_entries(cls, composites=0):
+    '''Estimated number of index rows an entity of cls has (kind index, asc
+    and desc built-in index per indexed property and composites composite
+    indexes). Repeated properties are counted once.'''
+    indexed = sum(1 for prop in cls._properties.itervalues() if prop._indexed)
+    return 1 + 2 * indexed + composites
 
 
 class Votable(object):
-    def _votes(self, cls):
-        query = cls.query(ancestor=self.key)
-        return query.fetch()
+    def counts_async(self, include_future=False, fields=None):
+        futures = {}
+        if wants(fields, 'upvote_count'):
+            futures['upvote_count'] = \
+                UpVote.query(ancestor=self.key).count_async()
+        if wants(fields, 'downvote_count'):
+            futures['downvote_count'] = \
+                DownVote.query(ancestor=self.key).count_async()
+        return futures
+
+
+class Publishable(object):
+    '''Post or Comment which can be scheduled (created in the future)'''
+    def is_due(self, now=None):
+        return self.created is None or self.created <= (now or datetime.now())
+
+    def update_published(self, now=None):
+        '''Set published from created time, returns published. Unpublished
+        objects need a Pending entry (see schedule).'''
+        if self.is_due(now):
+            self.publish()
+        else:
+            self.unpublish()
+        return self.published
 
-    def upvotes(self):
-        return self._votes(UpVote)
+    def publish(self):
+        self.published = True
 
-    def downvotes(self):
-        return self._votes(DownVote)
+    def unpublish(self):
+        self.published = False
 
-    def to_dict(self, include_future=False):
-        return {
-            'upvote_count': ilen(self.upvotes()),
-            'downvote_count': ilen(self.downvotes()),
-        }
 
+def schedule(objs):
+    '''Add Pending entries for unpublished objs (after they were put)'''
+    pending = [Pending.entry(obj) for obj in objs if not obj.published]
+    if pending:
+        ndb.put_multi(pending)
+    return pending
 
-class Post(Model, Votable):
+
+class Post(Model, Votable, Publishable):
     '''Post, ancestor will be the user'''
-    content = ndb.StringProperty()
-    theme = ndb.StringProperty()
-    background = ndb.StringProperty()
+    content = ndb.StringProperty(indexed=False)
+    theme = ndb.StringProperty(indexed=False)
+    background = ndb.StringProperty(indexed=False)
     # FIXME: Do we want to randomize?
     created = ndb.DateTimeProperty(auto_now_add=True)
     # List of channels this post is belong to
     channels = ndb.StringProperty(repeated=True)
     # User specified data
-    role = ndb.StringProperty()
+    role = ndb.StringProperty(indexed=False)
     role_text = ndb.TextProperty()
 
-    # Map of uid -> (uid, icon id)
+    # Legacy map of uid -> post uid, moved to PostUsers (see post_user)
     uid_map = ndb.PickleProperty()
+    # Hidden by moderation (see Flag)
+    hidden = ndb.BooleanProperty(default=False, indexed=False)
+    # Scheduled posts are published at created time (see Pending)
+    published = ndb.BooleanProperty(default=True, indexed=False)
+    scheduled_channels = ndb.StringProperty(repeated=True, indexed=False)
 
     json_attrs = set([
         'content', 'role', 'role_text', 'theme', 'background', 'channels',
@@ -205,39 +548,67 @@ class Post(Model, Votable):
     @staticmethod
     def create(user, content, theme, background, channels, role,
                role_text, created=None):
-        post_uid = 0
-        uid_map = {user.uid(): post_uid}
+        # Post creator (the parent) is post user 0, see PostUsers
         post = Post(
             content=content,
             theme=theme,
             background=background,
             channels=channels,
-            uid_map=uid_map,
             parent=user.key,
             role=role,
             role_text=role_text,
         )
         if created:
             post.created = created
+        post.update_published()
         post.put()
+        schedule([post])
         return post
 
-    def comments(self, include_future=False):
+    def publish(self):
+        if not self.published:
+            self.channels = self.scheduled_channels
+            self.scheduled_channels = []
+        self.published = True
+
+    def unpublish(self):
+        if self.published:
+            self.scheduled_channels = self.channels
+            self.channels = []
+        self.published = False
+
+    def all_channels(self):
+        '''Channels of post, published or not'''
+        return self.channels if self.published else self.scheduled_channels
+
+    def comments_query(self, include_future=False):
+        query = Comment.query(ancestor=self.key)
         if not include_future:
-            query = Comment.query(Comment.created <= datetime.now(), ancestor=self.key).order(-Comment.created)
-        else:
-            query = Comment.query(ancestor=self.key).order(-Comment.created)
-        return query.iter()
+            if publishing_migrated:
+                query = query.filter(Comment.published == True)  # noqa: E712
+            else:
+                # Comments written before scheduling have no published index
+                query = query.filter(Comment.created <= datetime.now())
+        return query.order(-Comment.created)
 
-    def to_dict(self, include_future=False):
-        obj = super(Post, self).to_dict(include_future=include_future)
-        obj['comment_count'] = ilen(self.comments(include_future=include_future))
-        obj.update(Votable.to_dict(self, include_future=include_future))
-        return obj
+    def comments(self, include_future=False):
+        return self.comments_query(include_future).iter()
+
+    def counts_async(self, include_future=False, fields=None):
+        futures = Votable.counts_async(self, include_future, fields)
+        if wants(fields, 'comment_count'):
+            futures['comment_count'] = \
+                self.comments_query(include_future).count_async()
+        return futures
 
     def parent_post(self):
         return self
 
+    def parent_post_async(self):
+        future = ndb.Future()
+        future.set_result(self)
+        return future
+
 
 def new_random_uid(existing):
     # We don't do "while True" here so if we get more than 1M users on a
@@ -250,39 +621,117 @@ def new_random_uid(existing):
     return uid
 
 
-@ndb.transactional
+class PostUsers(Model):
+    '''Post users map, child of the post'''
+    # Map of uid -> post uid
+    uid_map = ndb.PickleProperty()
+
+    @staticmethod
+    def key_for(post_key):
+        return ndb.Key(PostUsers, 1, parent=post_key)
+
+    @staticmethod
+    def initial_map(post):
+        '''Map of a post without PostUsers (legacy map or just the creator)'''
+        if post.uid_map:
+            return dict(post.uid_map)
+        return {encode_key(post.key.parent()): 0}
+
+
+def migrate_post_users(post):
+    '''Move legacy Post.uid_map to PostUsers, must run in a transaction.'''
+    if post.uid_map is not None:
+        # Post we got might be stale (missing uids added since), the map is
+        # built from the one read in the transaction
+        post = post.key.get()
+    pusers = PostUsers(
+        key=PostUsers.key_for(post.key),
+        uid_map=PostUsers.initial_map(post),
+    )
+    if post.uid_map is None:
+        pusers.put()
+        return pusers
+
+    post.uid_map = None
+    ndb.put_multi([pusers, post])
+    return pusers
+
+
 def post_user(post, user):
-    uid = post.uid_map.get(user.uid())
+    return post_user_async(post, user).get_result()
+
+
+@ndb.tasklet
+def post_user_async(post, user):
+    attempts = [0]
+    try:
+        uid = yield _post_user_txn(post, user, attempts)
+    except datastore_errors.TransactionFailedError:
+        telemetry.record('contention.post_user_failed', post.key, sample=False)
+        raise
+
+    telemetry.record('write.post_user', post.key)
+    if attempts[0] > 1:
+        telemetry.record('contention.post_user_retries', post.key,
+                         attempts[0] - 1, sample=False)
+    raise ndb.Return(uid)
+
+
+@ndb.transactional_tasklet
+def _post_user_txn(post, user, attempts):
+    attempts[0] += 1  # Retries run this again
+    pusers = yield PostUsers.key_for(post.key).get_async()
+    if pusers is None:
+        pusers = migrate_post_users(post)
+
+    uid = pusers.uid_map.get(user.uid())
     if uid is None:
-        uid = new_random_uid(set(post.uid_map.itervalues()))
-        post.uid_map[user.uid()] = uid
-        # TODO: Think if we want to save here or elsewhere
-        post.put()
+        uid = new_random_uid(set(pusers.uid_map.itervalues()))
+        pusers.uid_map[user.uid()] = uid
+        yield pusers.put_async()
 
-    return uid
+    raise ndb.Return(uid)
+
+
+def post_uid_map(post):
+    '''Map of uid -> post uid of post (read only, does not migrate)'''
+    pusers = PostUsers.key_for(post.key).get()
+    if pusers:
+        return pusers.uid_map
+    return PostUsers.initial_map(post)
 
 
 def resolve_post_uid(post, uid):
-    for k, v in post.uid_map.iteritems():
+    for k, v in post_uid_map(post).iteritems():
         if v == uid:
             return k
 
 
-class Comment(Model, Votable):
+class Comment(Model, Votable, Publishable):
     '''Comment, ancestor will be the post'''
-    content = ndb.StringProperty()
-    user = ndb.IntegerProperty()
+    content = ndb.StringProperty(indexed=False)
+    user = ndb.IntegerProperty(indexed=False)
     created = ndb.DateTimeProperty(auto_now_add=True)
     # User specified data
-    role = ndb.StringProperty()
+    role = ndb.StringProperty(indexed=False)
     role_text = ndb.TextProperty()
+    # Hidden by moderation (see Flag)
+    hidden = ndb.BooleanProperty(default=False, indexed=False)
+    # Scheduled comments are published at created time (see Pending)
+    published = ndb.BooleanProperty(default=True)
 
     json_attrs = set(['role', 'role_text', 'content', 'created', 'user'])
     json_conv = {'user': 'icon'}
 
     @staticmethod
     def create(post, user, content, role, role_text, created=None):
-        uid = post_user(post, user)
+        return Comment.create_async(
+            post, user, content, role, role_text, created).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def create_async(post, user, content, role, role_text, created=None):
+        uid = yield post_user_async(post, user)
         comment = Comment(
             content=content,
             user=uid,
@@ -292,62 +741,110 @@ class Comment(Model, Votable):
         )
         if created:
             comment.created = created
-        comment.put()
-        return comment
+        published = comment.update_published()
+        yield comment.put_async()
+        if not published:
+            yield Pending.entry(comment).put_async()
+        raise ndb.Return(comment)
 
     def parent_post(self):
         return self.key.parent().get()
 
-    def to_dict(self, include_future=False):
-        obj = super(Comment, self).to_dict(include_future=include_future)
-        obj.update(Votable.to_dict(self, include_future=include_future))
-        return obj
+    def parent_post_async(self):
+        return self.key.parent().get_async()
+
+    def counts_async(self, include_future=False, fields=None):
+        return Votable.counts_async(self, include_future, fields)
 
 
 def delete_votes(cls, ancestor, uid):
+    delete_votes_async(cls, ancestor, uid).get_result()
+
+
+@ndb.tasklet
+def delete_votes_async(cls, ancestor, uid):
     query = cls.query(
         Vote.user == uid,
         ancestor=ancestor)
-    ndb.delete_multi(query.iter(keys_only=True))
+    keys = yield query.fetch_async(keys_only=True)
+    if keys:
+        yield ndb.delete_multi_async(keys)
 
 
 class Vote(Model):
+    '''Vote of a post user on a post or comment. Votes by users have the post
+    user id as key name (see key_for), seeded and imported votes have auto ids
+    or other names.'''
     user = ndb.IntegerProperty()
-    created = ndb.DateTimeProperty(auto_now_add=True)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, key, uid):
+        '''Key of vote of post user uid on key'''
+        return ndb.Key(cls, str(uid), parent=key)
 
     @staticmethod
     def create(obj, user, direction, delete_opposite=True):
-        post = obj.parent_post()
+        return Vote.create_async(
+            obj, user, direction, delete_opposite).get_result()
 
-        # FIXME: Prevent double voting
-        uid = post_user(post, user)
+    @staticmethod
+    @ndb.tasklet
+    def create_async(obj, user, direction, delete_opposite=True):
+        telemetry.record('write.vote', obj.key)
+        post = yield obj.parent_post_async()
+
+        uid = yield post_user_async(post, user)
         if direction == 'up':
             cls, del_cls = UpVote, DownVote
         else:
             cls, del_cls = DownVote, UpVote
 
-        # make sure to delete opposite votes before voting
+        # Voting again overwrites the vote
+        vote = cls(key=cls.key_for(obj.key, uid), user=uid)
+        # Opposite votes are other entities, delete them while we put
+        futures = [vote.put_async()]
         if delete_opposite:
-            delete_votes(del_cls, obj.key, uid)
+            futures.append(delete_votes_async(del_cls, obj.key, uid))
+        yield futures
 
-        obj = cls(user=uid, parent=obj.key)
-        obj.put()
+        raise ndb.Return(vote)
 
-        return obj
+    @staticmethod
+    def create_multi(obj, user, direction, count, uid=None):
+        '''Create count votes of user on obj with one put_multi (used for
+        seeding votes), uid is the post user id if already known.'''
+        if count <= 0:
+            return []
+
+        if uid is None:
+            uid = post_user(obj.parent_post(), user)
+        cls = UpVote if direction == 'up' else DownVote
+        votes = [cls(user=uid, parent=obj.key) for _ in xrange(count)]
+        ndb.put_multi(votes)
+        return votes
 
     @staticmethod
     def delete(obj, user, direction):
-        post = obj.parent_post()
+        Vote.delete_async(obj, user, direction).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def delete_async(obj, user, direction):
+        post = yield obj.parent_post_async()
 
         # FIXME: Prevent double voting
-        uid = post_user(post, user)
+        uid = yield post_user_async(post, user)
         cls = UpVote if direction == 'up' else DownVote
 
-        delete_votes(cls, obj.key, uid)
+        yield delete_votes_async(cls, obj.key, uid)
 
     def parent_post(self):
         return self.key.parent().get()
 
+    def parent_post_async(self):
+        return self.key.parent().get_async()
+
 
 class UpVote(Vote):
     pass
@@ -357,6 +854,59 @@ class DownVote(Vote):
     pass
 
 
+@ndb.tasklet
+def my_votes_async(user, keys):
+    '''Vote direction ('up', 'down' or None) of user on each of keys (posts
+    and comments) as key -> direction.
+
+    Read only, post users are not created or migrated. Post users maps (and
+    posts for legacy maps) are loaded with one get_multi, then the votes (see
+    Vote.key_for) with another. Until votes_keyed is set, votes with auto ids
+    are found with one up and one down votes query per post (ancestor is the
+    post so votes on its comments are included).
+    '''
+    votes = dict((key, None) for key in keys)
+    by_post = {}  # post key -> keys
+    for key in keys:
+        post_key = post_key_of(key)
+        if post_key:
+            by_post.setdefault(post_key, []).append(key)
+    post_keys = by_post.keys()
+    objs = yield ndb.get_multi_async(
+        [PostUsers.key_for(key) for key in post_keys] + post_keys)
+    pusers, posts = objs[:len(post_keys)], objs[len(post_keys):]
+
+    uid = user.uid()
+    vote_keys, queries = [], []
+    for post_key, post_users, post in zip(post_keys, pusers, posts):
+        if post_users:
+            uid_map = post_users.uid_map
+        elif post:
+            uid_map = PostUsers.initial_map(post)
+        else:
+            continue
+        post_uid = uid_map.get(uid)
+        if post_uid is None:
+            continue  # Never voted or commented on this post
+        for cls in (DownVote, UpVote):
+            vote_keys.extend(
+                cls.key_for(key, post_uid) for key in by_post[post_key])
+            if not votes_keyed:
+                query = cls.query(cls.user == post_uid, ancestor=post_key)
+                queries.append(query.fetch_async(keys_only=True))
+
+    found = yield ndb.get_multi_async(vote_keys)
+    vote_keys = [key for key, vote in zip(vote_keys, found) if vote]
+    for future in queries:
+        vote_keys.extend((yield future))
+    # An up vote wins if there are both (legacy double votes)
+    for vote_key in sorted(vote_keys, key=lambda key: key.kind() == 'UpVote'):
+        if vote_key.parent() in votes:
+            votes[vote_key.parent()] = \
+                'up' if vote_key.kind() == 'UpVote' else 'down'
+    raise ndb.Return(votes)
+
+
 def unique_updates(query):
     # Since we have can have multiple updates on an object and we'd like to get
     # just one update, and the fact that GQL DISTINCT is limited to full
@@ -377,10 +927,14 @@ class Channel(Model):
 
     title = ndb.StringProperty()
 
+    # Channels are rarely added, other instances see new ones after ttl
+    cache = LocalCache(ttl=60)
+
     @staticmethod
     def create(title):
         chan = Channel(title=title)
         chan.put()
+        Channel.cache.invalidate()
         return chan
 
     @staticmethod
@@ -390,38 +944,70 @@ class Channel(Model):
             return chan
 
     def find(self, since, key, count):
+        return self.find_async(since, key, count).get_result()
+
+    @ndb.tasklet
+    def find_async(self, since, key, count):
         chan = encode_key(self.key)
+        # Scheduled posts have no channels until published, future posts
+        # written before scheduling have them until migrated
+        now = None if publishing_migrated else datetime.now()
         if count > 0:
             query = Post.query(
                 Post.created >= since,
-                Post.created <= datetime.now(),
                 Post.channels == chan
             ).order(Post.created, Post.key)
+            if now:
+                query = query.filter(Post.created <= now)
             if key:
                 query.filter(ndb.GenericProperty("key") >= key)
         else:
             query = Post.query(
-                Post.created <= since,
+                Post.created <= (min(since, now) if now else since),
                 Post.channels == chan,
             ).order(-Post.created, -Post.key)
             if key:
                 query.filter(ndb.GenericProperty("key") <= key)
 
-        return query.fetch(abs(count))
+        posts = yield query.fetch_async(abs(count))
+        raise ndb.Return([post for post in posts if not post.hidden])
 
     @staticmethod
     def iter_all():
         query = Channel.query()
         return query.iter()
 
+    @staticmethod
+    def all_dicts():
+        '''Dicts of all channels (cached in process)'''
+        return Channel.cache.get(
+            'all', lambda: [chan.to_dict() for chan in Channel.iter_all()])
+
+
+def sort_key(shard, time):
+    '''Update.sort of shard at time (and bounds of shard queries)'''
+    return '{:02d}|{}'.format(shard, time.strftime(sort_time_fmt))
+
+
+def _newest_update(updates):
+    updates = [update for update in updates if update]
+    return max(updates, key=lambda update: update.sort[3:]) if updates \
+        else None
+
 
 class Update(Model):
     '''Represents update in a channel'''
-    created = ndb.DateTimeProperty(auto_now_add=True)
-    what = ndb.KeyProperty()  # Changed item
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    sort = ndb.StringProperty()  # See sort_key
+    what = ndb.KeyProperty(indexed=False)  # Changed item
     what_kind = ndb.StringProperty() # Kind of the object referenced by 'what'
     post = ndb.KeyProperty()  # Related post
-    channel = ndb.KeyProperty()
+    channel = ndb.KeyProperty(indexed=False)
+
+    def _pre_put_hook(self):
+        # created is set by now (auto_now_add)
+        if not self.sort:
+            self.sort = sort_key(randint(0, update_shards - 1), self.created)
 
     @staticmethod
     def create(chan, key, time):
@@ -442,24 +1028,180 @@ class Update(Model):
 
     @staticmethod
     def updates_for(keys, since, kinds=None):
+        return Update.updates_for_async(keys, since, kinds).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def updates_for_async(keys, since, kinds=None):
+        '''Future of the newest update of each object under keys (newest
+        first)'''
+        now = datetime.now()
+        futures = []
+        for shard in xrange(update_shards):
+            query = Update.query(
+                Update.sort >= sort_key(shard, since),
+                Update.sort <= sort_key(shard, now),
+                Update.post.IN(keys),
+            )
+            if kinds:
+                query = query.filter(Update.what_kind.IN(kinds))
+            futures.append(query.order(-Update.sort).fetch_async())
+
+        shards = yield futures
+        updates = [update for updates in shards for update in updates]
+        updates.sort(key=attrgetter('created'), reverse=True)
+        raise ndb.Return(list(unique_updates(updates)))
+
+    @staticmethod
+    @ndb.tasklet
+    def newest_async(post, what_kind, keys_only=False):
+        '''Future of newest update (or its key) of post/what_kind'''
+        futures = []
+        for shard in xrange(update_shards):
+            query = Update.query(
+                Update.post == post,
+                Update.what_kind == what_kind,
+                Update.sort >= sort_key(shard, datetime(1970, 1, 1)),
+                Update.sort <= sort_key(shard, datetime.max),
+            ).order(-Update.sort)
+            # sort has the time, a projection is as small as keys only
+            futures.append(query.get_async(
+                projection=[Update.sort] if keys_only else None))
+
+        newest = _newest_update((yield futures))
+        if keys_only and newest:
+            newest = newest.key
+        raise ndb.Return(newest)
+
+    @staticmethod
+    def compact(before, cursor=None, batch_size=500):
+        '''Delete a batch of updates created before `before`, keeping the
+        newest update of each (post, what_kind).
+
+        Updates are scanned shard by shard from newest to oldest, cursor is
+        the cursor returned by the previous call ("<shard> <urlsafe cursor>").
+        Returns (deleted count, cursor, more).
+        '''
+        shard = 0
+        if cursor:
+            shard, cursor = cursor.split(' ', 1)
+            shard = int(shard)
+            cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
         query = Update.query(
-            Update.created >= since,
-            Update.created <= datetime.now(),
-            Update.post.IN(keys),
-        )
-        if kinds:
-            query = query.filter(Update.what_kind.IN(kinds))
+            Update.sort >= sort_key(shard, datetime(1970, 1, 1)),
+            Update.sort < sort_key(shard, before),
+        ).order(-Update.sort)
+        updates, cursor, more = query.fetch_page(
+            batch_size, start_cursor=cursor)
+
+        # One keys only lookup per pair in the batch, all in flight at once
+        newest = {}
+        for update in updates:
+            pair = (update.post, update.what_kind)
+            if update.post and pair not in newest:
+                newest[pair] = Update.newest_async(*pair, keys_only=True)
+        ndb.Future.wait_all(newest.values())
+        keep = set(future.get_result() for future in newest.itervalues())
+
+        # Updates with no post are never read
+        keys = [update.key for update in updates if update.key not in keep]
+        ndb.delete_multi(keys)
+
+        if more and cursor:
+            return len(keys), '{} {}'.format(shard, cursor.urlsafe()), True
+        if shard + 1 < update_shards:
+            return len(keys), '{} '.format(shard + 1), True
+        return len(keys), None, False
+
+
+class Pending(Model):
+    '''Unpublished (scheduled) post or comment, key name is the object key'''
+    what = ndb.KeyProperty(indexed=False)
+    publish_at = ndb.DateTimeProperty()
 
-        return unique_updates(query.order(-Update.created))
+    @staticmethod
+    def key_for(key):
+        return ndb.Key(Pending, key.urlsafe())
+
+    @staticmethod
+    def entry(obj):
+        return Pending(
+            key=Pending.key_for(obj.key), what=obj.key, publish_at=obj.created)
+
+    @staticmethod
+    def due(now=None, limit=100):
+        '''Pending entries to publish, returns (entries, more)'''
+        query = Pending.query(Pending.publish_at <= (now or datetime.now()))
+        entries = query.order(Pending.publish_at).fetch(limit + 1)
+        return entries[:limit], len(entries) > limit
+
+
+class Moderation(Model):
+    '''Flags summary of a flagged object, key name is the object key'''
+    what = ndb.KeyProperty(indexed=False)
+    what_kind = ndb.StringProperty(indexed=False)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    last_flagged = ndb.DateTimeProperty()
+    # Was included in flags digest mail (reset on new flag)
+    digested = ndb.BooleanProperty(default=False)
+
+    json_attrs = set(['what', 'what_kind', 'count', 'last_flagged'])
+
+    @staticmethod
+    def key_for(key):
+        return ndb.Key(Moderation, key.urlsafe())
+
+    def add(self, count, time):
+        '''Add flags to count, returns True if what should be hidden'''
+        self.count += count
+        if not self.last_flagged or time > self.last_flagged:
+            self.last_flagged = time
+        self.digested = False
+        return self.count >= flag_hide_threshold
+
+    @staticmethod
+    def undigested(limit=500):
+        # ndb filters need ==
+        query = Moderation.query(Moderation.digested == False)  # noqa: E712
+        return query.fetch(limit)
+
+    @staticmethod
+    def mark_digested(mods):
+        '''Set digested of mods (in a transaction each) unless flagged again
+        since they were read, returns number of mods marked'''
+        futures = [_mark_digested(mod.key, mod.last_flagged) for mod in mods]
+        return sum(1 for future in futures if future.get_result())
+
+
+@ndb.transactional_tasklet
+def _mark_digested(key, last_flagged):
+    mod = yield key.get_async()
+    if not mod or mod.digested or mod.last_flagged != last_flagged:
+        raise ndb.Return(False)
+    mod.digested = True
+    yield mod.put_async()
+    raise ndb.Return(True)
 
 
 class Flag(Model):
-    created = ndb.DateTimeProperty(auto_now_add=True)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
 
     @staticmethod
+    @ndb.transactional(xg=True)
     def create(key, time):
+        '''Flag key, updates the moderation counter and hides key when there
+        are enough flags'''
         flag = Flag(created=time, parent=key)
-        flag.put()
+        mod_key = Moderation.key_for(key)
+        mod = mod_key.get() or \
+            Moderation(key=mod_key, what=key, what_kind=key.kind())
+        objs = [flag, mod]
+        if mod.add(1, time):
+            obj = key.get()
+            if getattr(obj, 'hidden', True) is False:
+                obj.hidden = True
+                objs.append(obj)
+        ndb.put_multi(objs)
 
         return flag
 
@@ -468,9 +1210,106 @@ class Flag(Model):
         return Flag.query(ancestor=obj.key)
 
 
+def post_key_of(key):
+    '''Key of the post key belongs to (or None)'''
+    while key and key.kind() != 'Post':
+        key = key.parent()
+    return key
+
+
+def is_ancestor(ancestor, key):
+    '''True if ancestor is key or one of its ancestors'''
+    pairs = ancestor.pairs()
+    return key.pairs()[:len(pairs)] == pairs
+
+
+class Job(Model):
+    '''Background job status, the job id is the encoded key.
+
+    Jobs run in chained tasks, each task handles one batch and saves the stage
+    and cursor to continue from.
+    '''
+    name = ndb.StringProperty(indexed=False)
+    target = ndb.KeyProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+    stage = ndb.StringProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    changed = ndb.IntegerProperty(default=0, indexed=False)  # Put/deleted
+    elapsed = ndb.FloatProperty(default=0, indexed=False)  # Seconds in batches
+    done = ndb.BooleanProperty(default=False, indexed=False)
+
+    json_attrs = set([
+        'name', 'target', 'created', 'updated', 'stage', 'processed',
+        'changed', 'elapsed', 'done',
+    ])
+
+    def to_dict(self, include_future=False, fields=None):
+        obj = super(Job, self).to_dict(
+            include_future=include_future, fields=fields)
+        if wants(fields, 'rate'):
+            # Entities per second
+            obj['rate'] = self.processed / self.elapsed if self.elapsed else 0
+        return obj
+
+    def advance(self, count, cursor, more, stages=()):
+        '''Record batch result, moves to next stage when current one is done'''
+        self.processed += count
+        if more and cursor:
+            self.cursor = cursor
+            return
+
+        self.cursor = None
+        if self.stage in stages and self.stage != stages[-1]:
+            self.stage = stages[list(stages).index(self.stage) + 1]
+        else:
+            self.done = True
+
+
+# Cascade delete stages, objects under the key then Updates referencing them
+cascade_stages = ('children', 'updates')
+
+
+def cascade_delete_batch(key, stage, cursor=None, batch_size=500):
+    '''Delete one batch of objects related to key (which can already be
+    deleted).
+
+    "children" stage deletes everything under key (comments, votes, flags
+    ...), "updates" stage deletes Update rows of key and its children. Returns
+    (deleted count, cursor, more).
+    '''
+    if cursor:
+        cursor = ndb.Cursor(urlsafe=cursor)
+
+    if stage == 'children':
+        query = ndb.Query(ancestor=key)
+        keys, cursor, more = query.fetch_page(
+            batch_size, start_cursor=cursor, keys_only=True)
+    elif stage == 'updates':
+        post_key = post_key_of(key)
+        if not post_key:
+            return 0, None, False
+        query = Update.query(Update.post == post_key)
+        if post_key == key:
+            # All updates of a post are about it or its children
+            keys, cursor, more = query.fetch_page(
+                batch_size, start_cursor=cursor, keys_only=True)
+        else:
+            updates, cursor, more = query.fetch_page(
+                batch_size, start_cursor=cursor)
+            keys = [update.key for update in updates
+                    if update.what and is_ancestor(key, update.what)]
+    else:
+        raise Error('unknown cascade delete stage - {}'.format(stage))
+
+    ndb.delete_multi(keys)
+    return len(keys), cursor.urlsafe() if cursor else None, more
+
+
 class Feedback(Model):
-    created = ndb.DateTimeProperty(auto_now_add=True)
-    user = ndb.KeyProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    user = ndb.KeyProperty(indexed=False)
     content = ndb.TextProperty()
 
     json_attrs = set(['created', 'user', 'content'])
@@ -484,14 +1323,19 @@ class Feedback(Model):
 
 
 def get_multi(keys):
+    return get_multi_async(keys).get_result()
+
+
+@ndb.tasklet
+def get_multi_async(keys):
     keys = list(decode_key_or_none(key) for key in keys)
     # return ndb.get_multi(list(key for key in keys if key))
     futures = [key.get_async() for key in keys if key]
     results = []
     for future in futures:
-        if future:
-            try:
-                results.append(future.get_result())
-            except:
-                pass
-    return results
+        try:
+            obj = yield future
+            results.append(obj)
+        except Exception:
+            pass
+    raise ndb.Return(results)
@@ -0,0 +1,167 @@
+'''Idempotent write requests.
+
+Clients (Twisted) may send the same write request more than once, write
+requests carry a request id (the "rid" query parameter or the Idempotency-Key
+header). The first request with a given id takes a lease (memcache.add) while
+it runs, its reply is stored in memcache and in the datastore (IdempotentReply)
+for the retry window. Retries get the stored reply, retries arriving while the
+first request is in flight poll until its reply is stored (or the lease is
+released, then one of them runs the write).
+
+Counters of absorbed duplicates are kept in memcache, see stats.
+'''
+from . import db
+
+from google.appengine.api import memcache
+
+from datetime import datetime, timedelta
+from functools import wraps
+from hashlib import sha1
+import httplib
+import logging as log
+import time
+
+header = 'Idempotency-Key'
+key_prefix = 'idem:'
+lease_prefix = key_prefix + 'lease:'
+reply_prefix = key_prefix + 'reply:'
+stats_prefix = key_prefix + 'stats:'
+retry_window = timedelta(days=1)
+reply_ttl = int(retry_window.total_seconds())
+# Longer than any write request, expires leases of crashed requests
+lease_ttl = 60
+# How long a retry waits for the in flight request (seconds)
+wait_timeout = 10
+poll_interval = 0.1
+counters = ['leased', 'replayed', 'waited', 'released', 'conflicts']
+
+
+class IdempotentReply(db.Model):
+    '''Stored reply of a write request, id is the request key'''
+    created = db.ndb.DateTimeProperty(auto_now_add=True)
+    content_type = db.ndb.StringProperty(indexed=False)
+    body = db.ndb.TextProperty()
+
+    def fresh(self):
+        return datetime.now() - self.created < retry_window
+
+
+def request_key(request):
+    '''Key for request (None if it has no request id), request ids are scoped
+    by user token, method and path'''
+    # Not request.get, it parses JSON bodies sent without a content type as
+    # forms (and rewrites the body)
+    rid = request.headers.get(header) or request.GET.get('rid')
+    if not rid:
+        return None
+    scope = '\n'.join([
+        request.headers.get('Authorization', ''),
+        request.method,
+        request.path,
+        rid,
+    ])
+    return sha1(scope.encode('utf-8')).hexdigest()
+
+
+def incr(name):
+    memcache.incr(stats_prefix + name, initial_value=0)
+
+
+def stats():
+    '''Counters since memcache was last flushed'''
+    values = memcache.get_multi(counters, key_prefix=stats_prefix)
+    return dict((name, values.get(name, 0)) for name in counters)
+
+
+def cached_reply(key):
+    return memcache.get(reply_prefix + key)
+
+
+def stored_reply(key):
+    '''Reply from the datastore (when evicted from memcache)'''
+    obj = IdempotentReply.get_by_id(key)
+    if not (obj and obj.fresh()):
+        return None
+    reply = (obj.content_type, obj.body)
+    memcache.set(reply_prefix + key, reply, reply_ttl)
+    return reply
+
+
+def acquire(key):
+    '''Take the lease for key, returns stored reply if the request was done'''
+    deadline = time.time() + wait_timeout
+    waited = False
+    while True:
+        reply = cached_reply(key)
+        if reply:
+            incr('waited' if waited else 'replayed')
+            return reply
+
+        if memcache.add(lease_prefix + key, 1, lease_ttl):
+            reply = stored_reply(key)
+            if reply:
+                memcache.delete(lease_prefix + key)
+                incr('replayed')
+                return reply
+            incr('leased')
+            return None
+
+        if time.time() > deadline:
+            incr('conflicts')
+            return False
+        waited = True
+        time.sleep(poll_interval)
+
+
+def store(key, content_type, body):
+    IdempotentReply(id=key, content_type=content_type, body=body).put()
+    memcache.set(reply_prefix + key, (content_type, body), reply_ttl)
+    memcache.delete(lease_prefix + key)
+
+
+def release(key):
+    '''Release the lease without a reply, the next retry runs the write'''
+    memcache.delete(lease_prefix + key)
+    incr('released')
+
+
+def idempotent(method):
+    '''Decorate write handler method, requests with the same request id get
+    the reply of the first one (only successful replies are stored)'''
+    @wraps(method)
+    def wrapper(handler, *args, **kw):
+        key = request_key(handler.request)
+        if not key:
+            return method(handler, *args, **kw)
+
+        reply = acquire(key)
+        if reply is False:
+            log.error('request %s still in flight', key)
+            handler.abort(
+                httplib.CONFLICT, headers={'Retry-After': str(lease_ttl)})
+        if reply:
+            log.info('duplicate request %s', key)
+            content_type, body = reply
+            handler.response.headers['Content-Type'] = str(content_type)
+            handler.response.write(body)
+            return
+
+        try:
+            method(handler, *args, **kw)
+        except BaseException:  # Including DeadlineExceededError
+            release(key)
+            raise
+
+        resp = handler.response
+        if resp.status_int == httplib.OK:
+            store(key, resp.headers.get('Content-Type'), resp.body)
+        else:
+            release(key)
+
+    return wrapper
+
+
+def purge_query(before=None):
+    '''Replies older than the retry window'''
+    before = before or datetime.now() - retry_window
+    return IdempotentReply.query(IdempotentReply.created < before)
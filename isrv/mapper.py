@@ -0,0 +1,226 @@
+'''Batched datastore mappers for migrations and backfills.
+
+A mapper pages through a query with cursors, maps each batch of entities to
+entities to put and keys to delete and writes them with put_multi/delete_multi.
+run_batch handles one batch and does not need the task queue (so it can be
+run against the local datastore stub), api.start_mapper runs a registered
+mapper in chained tasks with progress tracked in a db.Job.
+'''
+from . import db
+from . import idempotency
+
+from datetime import datetime
+
+
+mappers = {}  # name -> Mapper
+
+
+def register(mapper):
+    if mapper.name in mappers:
+        raise ValueError('duplicate mapper - {}'.format(mapper.name))
+    mappers[mapper.name] = mapper
+    return mapper
+
+
+def get_mapper(name):
+    return mappers.get(name)
+
+
+class Mapper(object):
+    '''Base mapper, override query and map (or map_batch)'''
+    name = None
+    batch_size = 200
+    keys_only = False
+
+    def query(self):
+        raise NotImplementedError
+
+    def map(self, obj):
+        '''Return (entities to put, keys to delete) for obj'''
+        return [], []
+
+    def map_batch(self, objs):
+        to_put, to_delete = [], []
+        for obj in objs:
+            put, delete = self.map(obj)
+            to_put.extend(put)
+            to_delete.extend(delete)
+        return to_put, to_delete
+
+    def run_batch(self, cursor=None):
+        '''Process one batch starting at cursor (urlsafe).
+
+        Returns (processed, changed, cursor, more).
+        '''
+        if cursor:
+            cursor = db.ndb.Cursor(urlsafe=cursor)
+        objs, cursor, more = self.query().fetch_page(
+            self.batch_size, start_cursor=cursor, keys_only=self.keys_only)
+
+        to_put, to_delete = self.map_batch(objs)
+        if to_put:
+            db.ndb.put_multi(to_put)
+        if to_delete:
+            db.ndb.delete_multi(to_delete)
+
+        changed = len(to_put) + len(to_delete)
+        return len(objs), changed, cursor.urlsafe() if cursor else None, more
+
+    def run(self):
+        '''Run all batches inline (for tests and small data sets)'''
+        processed = changed = 0
+        cursor = None
+        while True:
+            count, count_changed, cursor, more = self.run_batch(cursor)
+            processed += count
+            changed += count_changed
+            if not (more and cursor):
+                return processed, changed
+
+
+class RePut(Mapper):
+    '''Re-put all entities of a kind (e.g. after changing indexed)'''
+    def __init__(self, cls):
+        self.cls = cls
+        self.name = 'reput-{}'.format(cls.__name__)
+
+    def query(self):
+        return self.cls.query()
+
+    def map_batch(self, objs):
+        return objs, []
+
+
+@db.ndb.transactional
+def migrate_post_users(post):
+    if db.PostUsers.key_for(post.key).get() is None:
+        db.migrate_post_users(post)
+
+
+class MigratePostUsers(Mapper):
+    '''Move Post.uid_map of all posts to PostUsers (instead of lazily on the
+    next post_user)'''
+    name = 'migrate-post-users'
+
+    def query(self):
+        return db.Post.query()
+
+    def map(self, post):
+        # Writes are done in a transaction per post
+        if post.uid_map is not None:
+            migrate_post_users(post)
+        return [], []
+
+
+@db.ndb.transactional(xg=True)
+def backfill_moderation(key):
+    obj = key.get()
+    if not obj:
+        return
+    flags = db.Flag.flags_for(obj).fetch()
+    mod_key = db.Moderation.key_for(key)
+    mod = mod_key.get() or db.Moderation(
+        key=mod_key, what=key, what_kind=key.kind())
+    # Flags already in count were added by Flag.create (others were stored
+    # while Moderation was contended or before it existed)
+    missing = len(flags) - mod.count
+    if missing <= 0:
+        return
+    to_put = [mod]
+    last = max(flag.created for flag in flags)
+    if mod.add(missing, last) and getattr(obj, 'hidden', True) is False:
+        obj.hidden = True
+        to_put.append(obj)
+    db.ndb.put_multi(to_put)
+
+
+class BackfillModeration(Mapper):
+    '''Count flags written before Moderation existed (run once, Moderation
+    count is set from the flags of each object so re-runs change nothing)'''
+    name = 'backfill-moderation'
+    keys_only = True
+
+    def query(self):
+        return db.Flag.query()
+
+    def map_batch(self, keys):
+        # Writes are done in a transaction per flagged object
+        for key in set(key.parent() for key in keys):
+            backfill_moderation(key)
+        return [], []
+
+
+class SchedulePublishing(Mapper):
+    '''Set published (and add Pending entries) for objects of cls written
+    before scheduled publishing, all comments are re-put so
+    Comment.published is indexed, for posts only future ones are changed'''
+    def __init__(self, cls):
+        self.cls = cls
+        self.name = 'schedule-{}'.format(cls.__name__)
+
+    def query(self):
+        if self.cls is db.Post:
+            return db.Post.query(db.Post.created > datetime.now())
+        return self.cls.query()
+
+    def map_batch(self, objs):
+        now = datetime.now()
+        for obj in objs:
+            obj.update_published(now)
+        pending = [db.Pending.entry(obj) for obj in objs if not obj.published]
+        return objs + pending, []
+
+
+class KeyVotes(Mapper):
+    '''Give votes with auto ids of each (object, post user) one vote keyed by
+    the post user id (see db.Vote.key_for), other auto id votes of the user
+    (seeded counts) are kept so counts don't change. When done set
+    db.votes_keyed.'''
+    def __init__(self, cls):
+        self.cls = cls
+        self.name = 'key-{}'.format(cls.__name__)
+
+    def query(self):
+        return self.cls.query()
+
+    def map_batch(self, votes):
+        legacy = {}  # keyed vote key -> vote with auto id
+        for vote in votes:
+            if vote.key.integer_id() is not None and vote.user is not None:
+                key = self.cls.key_for(vote.key.parent(), vote.user)
+                legacy.setdefault(key, vote)
+        keys = legacy.keys()
+        to_put, to_delete = [], []
+        for key, keyed in zip(keys, db.ndb.get_multi(keys)):
+            if keyed:
+                continue  # Voted since or keyed by an earlier batch
+            vote = legacy[key]
+            to_put.append(self.cls(key=key, user=vote.user,
+                                   created=vote.created))
+            to_delete.append(vote.key)
+        return to_put, to_delete
+
+
+class PurgeReplies(Mapper):
+    '''Delete stored idempotent replies older than the retry window (cron)'''
+    name = 'purge-replies'
+    batch_size = 500
+    keys_only = True
+
+    def query(self):
+        return idempotency.purge_query()
+
+    def map_batch(self, keys):
+        return [], keys
+
+
+for cls in [db.User, db.Post, db.Comment, db.UpVote, db.DownVote, db.Update,
+            db.Flag, db.Feedback]:
+    register(RePut(cls))
+register(MigratePostUsers())
+register(BackfillModeration())
+register(SchedulePublishing(db.Post))
+register(SchedulePublishing(db.Comment))
+register(KeyVotes(db.UpVote))
+register(KeyVotes(db.DownVote))
+register(PurgeReplies())
@@ -0,0 +1,161 @@
+'''On demand per request profiling.
+
+A request is profiled when it has the X-Profile header and comes from an admin
+(or the local server), or when sampling is enabled (see set_sample, profile one
+in N requests). Profiled requests run under cProfile, the top functions and
+the timeline of API RPCs (datastore, memcache ...) are logged and stored in
+memcache under the request id, which is returned in the X-Profile-Id header.
+'''
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.api import users
+
+from cStringIO import StringIO
+from datetime import datetime
+from random import randint
+from uuid import uuid4
+import cProfile
+import logging as log
+import pstats
+import threading
+import time
+
+profile_header = 'X-Profile'
+id_header = 'X-Profile-Id'
+key_prefix = 'profile:'
+recent_key = key_prefix + 'recent'
+sample_key = key_prefix + 'sample'
+max_recent = 50
+top_count = 30
+profile_ttl = 24 * 60 * 60
+# How often we re-read the sample rate from memcache (seconds)
+sample_refresh = 30
+
+_local = threading.local()
+_sample = {'rate': 0, 'read': 0}
+
+
+def _pre_call(service, call, request, response):
+    rpcs = getattr(_local, 'rpcs', None)
+    if rpcs is not None:
+        rpcs[id(request)] = (time.time(), '{}.{}'.format(service, call))
+
+
+def _post_call(service, call, request, response, rpc=None, error=None):
+    rpcs = getattr(_local, 'rpcs', None)
+    if rpcs is None:
+        return
+    start, name = rpcs.pop(id(request), (None, None))
+    if start is None:
+        return
+    _local.timeline.append({
+        'rpc': name,
+        'start': (start - _local.start) * 1000,
+        'ms': (time.time() - start) * 1000,
+        'error': str(error) if error else None,
+    })
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+    'profiling-pre', _pre_call)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'profiling-post', _post_call)
+
+
+def set_sample(rate):
+    '''Profile one in rate requests (0 disables)'''
+    memcache.set(sample_key, rate)
+    _sample.update(rate=rate, read=time.time())
+
+
+def sample_rate():
+    now = time.time()
+    if now - _sample['read'] > sample_refresh:
+        _sample.update(rate=memcache.get(sample_key) or 0, read=now)
+    return _sample['rate']
+
+
+def top_functions(prof, count=top_count):
+    stats = pstats.Stats(prof, stream=StringIO())
+    funcs = []
+    for (fname, line, func), (cc, nc, tt, ct, _) in stats.stats.iteritems():
+        funcs.append({
+            'func': '{}:{}({})'.format(fname, line, func),
+            'calls': nc,
+            'own_ms': tt * 1000,
+            'cum_ms': ct * 1000,
+        })
+    funcs.sort(key=lambda func: func['own_ms'], reverse=True)
+    return funcs[:count]
+
+
+def save(profile):
+    key = key_prefix + profile['id']
+    memcache.set(key, profile, profile_ttl)
+    summary = dict((name, profile[name])
+                   for name in ('id', 'time', 'method', 'path', 'ms', 'rpcs'))
+    recent = memcache.get(recent_key) or []
+    recent = [summary] + recent[:max_recent - 1]
+    memcache.set(recent_key, recent, profile_ttl)
+
+
+def recent_profiles():
+    return memcache.get(recent_key) or []
+
+
+def get_profile(profile_id):
+    return memcache.get(key_prefix + profile_id)
+
+
+class ProfileMiddleware(object):
+    '''WSGI middleware profiling selected requests'''
+    def __init__(self, app, local=False):
+        self.app = app
+        self.local = local  # Allow profile header from anyone
+
+    def wanted(self, environ):
+        if ('HTTP_' + profile_header.upper().replace('-', '_')) in environ:
+            return self.local or users.is_current_user_admin()
+
+        rate = sample_rate()
+        return rate > 0 and randint(1, rate) == 1
+
+    def __call__(self, environ, start_response):
+        if not self.wanted(environ):
+            return self.app(environ, start_response)
+
+        profile_id = environ.get('REQUEST_LOG_ID') or uuid4().hex
+
+        def profiled_start_response(status, headers, exc_info=None):
+            headers = list(headers) + [(id_header, profile_id)]
+            return start_response(status, headers, exc_info)
+
+        _local.rpcs, _local.timeline = {}, []
+        _local.start = time.time()
+        prof = cProfile.Profile()
+        try:
+            return prof.runcall(self.app, environ, profiled_start_response)
+        finally:
+            elapsed = (time.time() - _local.start) * 1000
+            timeline = _local.timeline
+            _local.rpcs = _local.timeline = None
+            profile = {
+                'id': profile_id,
+                'time': datetime.now(),
+                'method': environ.get('REQUEST_METHOD'),
+                'path': environ.get('PATH_INFO'),
+                'query': environ.get('QUERY_STRING'),
+                'ms': elapsed,
+                'rpcs': len(timeline),
+                'rpc_ms': sum(rpc['ms'] for rpc in timeline),
+                'timeline': timeline,
+                'top': top_functions(prof),
+            }
+            log.info('profile %s: %s %s %.1fms, %d RPCs (%.1fms), top: %s',
+                     profile_id, profile['method'], profile['path'], elapsed,
+                     profile['rpcs'], profile['rpc_ms'],
+                     ', '.join(func['func'] for func in profile['top'][:5]))
+            try:
+                save(profile)
+            except Exception as err:
+                log.error('cannot save profile %s - %s', profile_id, err)
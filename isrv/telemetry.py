@@ -0,0 +1,125 @@
+'''Sampled access counters of hot keys (posts, channels ...).
+
+Accesses are recorded per operation (e.g. "read.items", "write.vote"), one in
+sample_rate accesses is counted (with weight sample_rate). Each instance keeps
+an approximate top-K per operation (Space-Saving: at capacity the smallest
+counter is replaced and the new key inherits its count, so counts are upper
+bounds) and every flush_interval seconds merges it into the current window in
+memcache. hot_keys sums the recent windows.
+
+Contention counters (e.g. post_user transaction retries) are recorded with
+sample=False so every event is counted.
+'''
+from google.appengine.api import memcache
+
+from random import randint
+import logging as log
+import threading
+import time
+
+key_prefix = 'hot:'
+sample_rate = 10
+capacity = 200  # Counters per operation per instance
+keep = 100  # Counters per operation per window in memcache
+flush_interval = 60
+window = 10 * 60
+windows = 6  # hot_keys looks at the last hour
+cas_retries = 3
+
+_lock = threading.Lock()
+_counts = {}  # op -> {key: count}
+_last_flush = [time.time()]
+
+
+def _add(counts, key, count):
+    if key in counts or len(counts) < capacity:
+        counts[key] = counts.get(key, 0) + count
+        return
+    smallest = min(counts, key=counts.get)
+    counts[key] = counts.pop(smallest) + count
+
+
+def record(op, key, count=1, sample=True):
+    '''Record count accesses of op to key (ndb key or string)'''
+    if sample:
+        if randint(1, sample_rate) != 1:
+            return
+        count *= sample_rate
+
+    key = key.urlsafe() if hasattr(key, 'urlsafe') else str(key)
+    now = time.time()
+    with _lock:
+        _add(_counts.setdefault(op, {}), key, count)
+        # One thread flushes
+        due = now - _last_flush[0] > flush_interval
+        if due:
+            _last_flush[0] = now
+    if due:
+        flush()
+
+
+def record_multi(op, keys):
+    for key in keys:
+        record(op, key)
+
+
+def window_key(op, start):
+    return '{}{}:{}'.format(key_prefix, op, int(start // window))
+
+
+def _merge(key, counts):
+    client = memcache.Client()
+    for _ in xrange(cas_retries):
+        current = client.gets(key)
+        if current is None:
+            merged = dict(counts)
+            if client.add(key, _top(merged, keep), window * (windows + 1)):
+                return True
+            continue
+        merged = dict(current)
+        for k, count in counts.iteritems():
+            merged[k] = merged.get(k, 0) + count
+        if client.cas(key, _top(merged, keep), window * (windows + 1)):
+            return True
+    return False
+
+
+def _top(counts, count):
+    top = sorted(counts.iteritems(), key=lambda item: item[1], reverse=True)
+    return dict(top[:count])
+
+
+def flush():
+    '''Merge counters of this instance into memcache'''
+    with _lock:
+        counts = dict(_counts)
+        _counts.clear()
+
+    now = time.time()
+    ops = sorted(counts)
+    for op in ops:
+        if not _merge(window_key(op, now), counts[op]):
+            log.warning('cannot merge hot keys of %s (contention)', op)
+    memcache.set(key_prefix + 'ops', sorted(
+        set(ops) | set(memcache.get(key_prefix + 'ops') or [])))
+
+
+def hot_keys(count=20):
+    '''Top count keys per operation in the recent windows as
+    op -> [(key, count), ...]'''
+    now = time.time()
+    ops = memcache.get(key_prefix + 'ops') or []
+    keys = [window_key(op, now - i * window)
+            for op in ops for i in xrange(windows)]
+    values = memcache.get_multi(keys)
+
+    hot = {}
+    for op in ops:
+        totals = {}
+        for i in xrange(windows):
+            for key, num in values.get(window_key(op, now - i * window),
+                                       {}).iteritems():
+                totals[key] = totals.get(key, 0) + num
+        hot[op] = sorted(
+            totals.iteritems(), key=lambda item: item[1], reverse=True)[:count]
+    return hot
@@ -1,9 +1,16 @@
 '''Handle web admin console'''
 # FIXME: Auth
 
-from api import is_local_srv, jsonify
+from api import is_local_srv, jsonify, start_cascade_delete, start_mapper
+from api import start_import
+import bulk
 import db
+import idempotency
+import mapper
+import profiling
+import telemetry
 
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.datastore.datastore_query import Cursor
 import jinja2
@@ -15,6 +22,7 @@ import json
 import logging as log
 from datetime import datetime
 
+templates = ['we-posts.html', 'we-comments.html']
 get_template = jinja2.Environment(
     loader=jinja2.FileSystemLoader(dirname(__file__))).get_template
 
@@ -45,9 +53,27 @@ def edit_users():
     return users
 
 
+# Editors and edit users are cached in process and in memcache, InitHandler
+# invalidates (other instances see the change after the ttl)
+editor_cache = db.LocalCache(ttl=60)
+editors_mc_key = 'webedit:editors'
+edit_users_mc_key = 'webedit:edit-users'
+
+
+def cached_edit_users():
+    '''Edit users entities (cached, do not modify)'''
+    def load():
+        keys = memcache.get(edit_users_mc_key)
+        if keys is None:
+            keys = edit_users()
+            memcache.set(edit_users_mc_key, keys)
+        return db.ndb.get_multi(keys)
+
+    return editor_cache.get('edit-users', load)
+
+
 def edit_user():
-    users = edit_users()
-    return users[0].get()
+    return cached_edit_users()[0]
 
 
 edit_time_fmts = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M']
@@ -61,11 +87,28 @@ def edit_str2dt(v):
     return None
 
 class Editor(db.Model):
-    email = db.ndb.StringProperty()
+    email = db.ndb.StringProperty(indexed=False)
+
+
+def editor_emails():
+    '''Set of editors emails (cached)'''
+    def load():
+        emails = memcache.get(editors_mc_key)
+        if emails is None:
+            emails = set(editor.email for editor in Editor.query())
+            memcache.set(editors_mc_key, emails)
+        return emails
+
+    return editor_cache.get('editors', load)
+
+
+def invalidate_editor_cache():
+    memcache.delete_multi([editors_mc_key, edit_users_mc_key])
+    editor_cache.invalidate()
 
 
 def is_editor(email):
-    return Editor.query(Editor.email == email).count() > 0
+    return email in editor_emails()
 
 
 def assert_editor(handler, user=None):
@@ -95,10 +138,10 @@ class Page(webapp2.RequestHandler):
             obj = db.decode_key(key).get()
         self.response.write(template.render(
             user=user,
-            edit_users=list(k.get() for k in edit_users()),
+            edit_users=cached_edit_users(),
             logout=logout,
             obj=obj,
-            channels=[c.to_dict() for c in db.Channel.iter_all()],
+            channels=db.Channel.all_dicts(),
         ))
 
 
@@ -106,10 +149,6 @@ class PostsPage(Page):
     template = 'we-posts.html'
 
 
-def is_flagged(post):
-    return any(flag for flag in db.Flag.flags_for(post))
-
-
 class JSONHandler(webapp2.RequestHandler):
     def respond(self, obj):
         self.response.headers['Content-Type'] = 'application/json'
@@ -121,21 +160,17 @@ class JSONHandler(webapp2.RequestHandler):
         cur = Cursor(urlsafe=self.request.get('cur'))
         count = int(self.request.get('count', 500))
         objs, cur, more = self.query(key).fetch_page(count, start_cursor=cur)
-        user_key_to_desc = dict((key, key.get().pub_key) for key in edit_users())
+        user_key_to_desc = dict(
+            (user.key, user.pub_key) for user in cached_edit_users())
         resp = {
-            'items': [self.to_dict(obj, user_key_to_desc) for obj in objs],
+            'items': self.to_dicts(objs, user_key_to_desc),
             'cur': cur.urlsafe() if cur else None,
             'more': more,
         }
         self.respond(resp)
 
-    def to_dict(self, obj, user_key_to_desc):
-        return obj.to_dict(include_future=True)
-
-    def delete_related_objects(self, key):
-        db.Update.delete_multi(ancestor_key=key)
-        db.UpVote.delete_multi(ancestor_key=key)
-        db.DownVote.delete_multi(ancestor_key=key)
+    def to_dicts(self, objs, user_key_to_desc):
+        return db.to_dicts(objs, include_future=True)
 
     def delete(self, key=None):
         assert_editor(self)
@@ -150,30 +185,32 @@ class JSONHandler(webapp2.RequestHandler):
             log.error('bad key %s', err)
             self.abort(httplib.BAD_REQUEST)
 
-        self.delete_related_objects(key)
-
+        # Object is gone right away, comments, votes, flags and updates are
+        # deleted in the background
         key.delete()
-        self.respond({'ok': True})
+        job = start_cascade_delete(key)
+        self.respond({'ok': True, 'job': db.encode_key(job.key)})
 
     def gen_votes(self, obj, user, data):
-        for i in range(int(data['upvote_count'])):
-            db.Vote.create(obj, user, 'up', delete_opposite=False)
-        for i in range(int(data['downvote_count'])):
-            db.Vote.create(obj, user, 'down', delete_opposite=False)
-
-    def update_votes_cls(self, obj, user, count, cls, uid=None):
-        post = obj.parent_post()
-        uid = uid or db.post_user(obj.parent_post(), user)
+        up, down = int(data['upvote_count']), int(data['downvote_count'])
+        if not (up or down):
+            return
+        uid = db.post_user(obj.parent_post(), user)
+        db.Vote.create_multi(obj, user, 'up', up, uid)
+        db.Vote.create_multi(obj, user, 'down', down, uid)
+
+    def update_votes_cls(self, obj, user, count, cls, uid):
         query = cls.query(cls.user == uid, ancestor=obj.key)
         existing = query.count()
         direction = 'up' if cls == db.UpVote else 'down'
         if existing < count:
-            for i in range(count - existing):
-                db.Vote.create(obj, user, direction, delete_opposite=False)
+            db.Vote.create_multi(obj, user, direction, count - existing, uid)
         elif existing > count:
             db.ndb.delete_multi(query.fetch(keys_only=True, limit=(existing - count)))
 
     def update_votes(self, obj, user, data, uid=None):
+        if uid is None:
+            uid = db.post_user(obj.parent_post(), user)
         self.update_votes_cls(obj, user, int(data['upvote_count']), db.UpVote, uid)
         self.update_votes_cls(obj, user, int(data['downvote_count']), db.DownVote, uid)
 
@@ -182,19 +219,24 @@ class JSONHandler(webapp2.RequestHandler):
 
 
 class JSPosts(JSONHandler):
-    def to_dict(self, post, user_key_to_desc):
-        d = super(JSPosts, self).to_dict(post, user_key_to_desc)
-        user_key = post.key.parent()
-        d['user'] = user_key_to_desc.get(user_key, user_key.urlsafe())
-        d['flagged'] = is_flagged(post)
-        return d
+    def to_dicts(self, posts, user_key_to_desc):
+        mods = db.ndb.get_multi_async(
+            [db.Moderation.key_for(post.key) for post in posts])
+        dicts = super(JSPosts, self).to_dicts(posts, user_key_to_desc)
+        for post, d, mod in zip(posts, dicts, mods):
+            user_key = post.key.parent()
+            d['user'] = user_key_to_desc.get(user_key, user_key.urlsafe())
+            mod = mod.get_result()
+            d['flagged'] = mod is not None
+            d['flag_count'] = mod.count if mod else 0
+            d['hidden'] = post.hidden
+            d['published'] = post.published
+            d['channels'] = post.all_channels()
+        return dicts
 
     def query(self, key):
         return db.Post.query().order(-db.Post.created)
 
-    def delete_related_objects(self, key):
-        db.Comment.delete_multi(ancestor_key=key)
-
     def post(self, ignored=None):
         assert_editor(self)
 
@@ -267,7 +309,55 @@ class JSPosts(JSONHandler):
         post.role_text = data['role_text']
         if created:
             post.created = created
+        post.update_published()
         post.put()
+        db.schedule([post])
+        self.respond({'ok': True})
+
+
+class JSFlagged(JSONHandler):
+    '''Moderation queue, most recently flagged first'''
+    def query(self, key):
+        return db.Moderation.query().order(-db.Moderation.last_flagged)
+
+    def to_dicts(self, mods, user_key_to_desc):
+        dicts = db.to_dicts(mods)
+        objs = db.ndb.get_multi([mod.what for mod in mods])
+        # Any kind can be flagged, only posts and comments have these
+        for d, obj in zip(dicts, objs):
+            d['hidden'] = getattr(obj, 'hidden', None)
+            d['content'] = getattr(obj, 'content', None)
+        return dicts
+
+    def put(self, key=None):
+        '''Set hidden of flagged object (body is {"hidden": true/false})'''
+        assert_editor(self)
+        try:
+            data = json.loads(self.request.body)
+            hidden = bool(data['hidden'])
+        except (ValueError, TypeError, KeyError) as err:
+            log.error('bad put - %s', err)
+            self.abort(httplib.BAD_REQUEST)
+
+        obj = db.decode_key_or_none(key)
+        obj = obj.get() if obj else None
+        if not isinstance(obj, (db.Post, db.Comment)):
+            log.error('unknown object - %s', key)
+            self.abort(httplib.NOT_FOUND)
+
+        obj.hidden = hidden
+        obj.put()
+        self.respond({'ok': True})
+
+    def delete(self, key=None):
+        '''Dismiss flagged object from the queue'''
+        assert_editor(self)
+        obj_key = db.decode_key_or_none(key)
+        if not obj_key:
+            log.error('bad key - %s', key)
+            self.abort(httplib.BAD_REQUEST)
+
+        db.Moderation.key_for(obj_key).delete()
         self.respond({'ok': True})
 
 
@@ -280,14 +370,23 @@ class JSComments(JSONHandler):
         key = db.decode_key(key)
         return db.Comment.query(ancestor=key).order(-db.Comment.created)
 
-    def to_dict(self, obj, user_key_to_desc):
-        d = super(JSComments, self).to_dict(obj, user_key_to_desc)
-        user_key = db.resolve_post_uid(obj.parent_post(), obj.user)
-        if user_key:
-            d['user'] = user_key_to_desc.get(db.decode_key(user_key), user_key)
-        else:
-            d['user'] = 'unknown'
-        return d
+    def to_dicts(self, comments, user_key_to_desc):
+        dicts = super(JSComments, self).to_dicts(comments, user_key_to_desc)
+        post_uids = {}  # post key -> {post uid: uid}
+        for comment, d in zip(comments, dicts):
+            post_key = comment.key.parent()
+            if post_key not in post_uids:
+                post = post_key.get()
+                uid_map = db.post_uid_map(post) if post else {}
+                post_uids[post_key] = \
+                    dict((v, k) for k, v in uid_map.iteritems())
+            user_key = post_uids[post_key].get(comment.user)
+            if user_key:
+                d['user'] = user_key_to_desc.get(
+                    db.decode_key(user_key), user_key)
+            else:
+                d['user'] = 'unknown'
+        return dicts
 
     def post(self, key=None):
         assert_editor(self)
@@ -307,9 +406,9 @@ class JSComments(JSONHandler):
 
         euser = None
         user = data.get('user', None)
-        for u in edit_users():
-            if db.encode_key(u) == user:
-                euser = u.get()
+        for u in cached_edit_users():
+            if db.encode_key(u.key) == user:
+                euser = u
                 break
         if not euser:
             log.error('bad user (not edit user) - %s', user)
@@ -367,10 +466,141 @@ class JSComments(JSONHandler):
         comment.role_text = data['role_text']
         if created:
             comment.created = created
+        comment.update_published()
         comment.put()
+        db.schedule([comment])
         self.respond({'ok': True})
 
 
+class JSImport(webapp2.RequestHandler):
+    def post(self, ignored=None):
+        '''Import NDJSON posts (see bulk) in the background'''
+        assert_editor(self)
+        try:
+            channels = set(chan['key'] for chan in db.Channel.all_dicts())
+            items = bulk.parse_lines(self.request.body_file, channels)
+        except ValueError as err:
+            log.error('bad import - %s', err)
+            self.abort(httplib.BAD_REQUEST, str(err))
+
+        channel = db.decode_key_or_none(self.request.get('channel'))
+        if not channel:
+            channel = db.Channel.query().get(keys_only=True)
+        job = start_import(items, channel)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(jsonify(
+            {'ok': True, 'job': db.encode_key(job.key), 'count': len(items)}))
+
+
+class JSExport(webapp2.RequestHandler):
+    def get(self, ignored=None):
+        '''Page of posts as NDJSON, next page cursor is in X-Cursor header
+        (empty at the end)'''
+        assert_editor(self)
+        count = int(self.request.get('count', 100))
+        items, cur, more = bulk.export_page(self.request.get('cur'), count)
+        self.response.headers['Content-Type'] = 'application/x-ndjson'
+        self.response.headers['X-Cursor'] = str(cur if more and cur else '')
+        for item in items:
+            self.response.write(jsonify(item))
+            self.response.write('\n')
+
+
+class JSJobs(webapp2.RequestHandler):
+    def get(self, key=None):
+        assert_editor(self)
+        job = db.decode_key_or_none(key)
+        job = job.get() if job else None
+        if not isinstance(job, db.Job):
+            log.error('unknown job - %s', key)
+            self.abort(httplib.NOT_FOUND)
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(jsonify({'ok': True, 'job': job.to_dict()}))
+
+
+class JSMappers(webapp2.RequestHandler):
+    def get(self, name=None):
+        assert_editor(self)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(jsonify(
+            {'ok': True, 'mappers': sorted(mapper.mappers)}))
+
+    def post(self, name=None):
+        assert_editor(self)
+        try:
+            job = start_mapper(name)
+        except db.NotFound:
+            log.error('unknown mapper - %s', name)
+            self.abort(httplib.NOT_FOUND)
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(jsonify(
+            {'ok': True, 'job': db.encode_key(job.key)}))
+
+
+class JSProfiles(webapp2.RequestHandler):
+    def get(self, profile_id=None):
+        assert_editor(self)
+        if profile_id:
+            profile = profiling.get_profile(profile_id)
+            if not profile:
+                log.error('unknown profile - %s', profile_id)
+                self.abort(httplib.NOT_FOUND)
+            reply = {'ok': True, 'profile': profile}
+        else:
+            reply = {
+                'ok': True,
+                'sample': profiling.sample_rate(),
+                'profiles': profiling.recent_profiles(),
+            }
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(jsonify(reply))
+
+    def post(self, ignored=None):
+        '''Set sample rate (profile 1 in ?sample=N requests, 0 disables)'''
+        assert_editor(self)
+        try:
+            rate = int(self.request.get('sample', 0))
+        except ValueError:
+            log.error('bad sample - %s', self.request.get('sample'))
+            self.abort(httplib.BAD_REQUEST)
+
+        profiling.set_sample(rate)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(jsonify({'ok': True, 'sample': rate}))
+
+
+class JSIdempotency(webapp2.RequestHandler):
+    def get(self, ignored=None):
+        '''Counters of duplicate write requests absorbed'''
+        assert_editor(self)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(jsonify(
+            {'ok': True, 'stats': idempotency.stats()}))
+
+
+class JSHotKeys(webapp2.RequestHandler):
+    def get(self, ignored=None):
+        '''Top ?count=N keys per operation in the last hour (reads, writes
+        and post_user transaction contention)'''
+        assert_editor(self)
+        try:
+            count = int(self.request.get('count', 20))
+        except ValueError:
+            log.error('bad count - %s', self.request.get('count'))
+            self.abort(httplib.BAD_REQUEST)
+
+        telemetry.flush()  # Include this instance counters
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(jsonify({
+            'ok': True,
+            'sample_rate': telemetry.sample_rate,
+            'hot': telemetry.hot_keys(count),
+        }))
+
+
 editors = [
     'someone@gmail.com',
 ]
@@ -384,12 +614,21 @@ class InitHandler(webapp2.RequestHandler):
             count += 1
             e = Editor(email=email)
             e.put()
+        invalidate_editor_cache()
 
         reply = {'ok': True, 'added': count}
         self.response.headers['Content-Type'] = 'application/json'
         self.response.write(jsonify(reply))
 
 
+def warmup():
+    '''Compile templates and load editors and edit users caches'''
+    for name in templates:
+        get_template(name)
+    cached_edit_users()
+    editor_emails()
+
+
 route_prefix = '/_we'
 routes = []
 #from datetime import datetime
@@ -400,7 +639,17 @@ if True: #(datetime.now() < d):
         (route_prefix + '/js/posts/(.*)', JSPosts),
         (route_prefix + '/comments/(.*)', CommentsPage),
         (route_prefix + '/js/comments/(.*)', JSComments),
+        (route_prefix + '/js/flagged/(.*)', JSFlagged),
+        (route_prefix + '/js/jobs/(.*)', JSJobs),
+        (route_prefix + '/js/import/(.*)', JSImport),
+        (route_prefix + '/js/export/(.*)', JSExport),
+        (route_prefix + '/js/mappers/(.*)', JSMappers),
+        (route_prefix + '/js/profiles/(.*)', JSProfiles),
+        (route_prefix + '/js/idempotency/(.*)', JSIdempotency),
+        (route_prefix + '/js/hotkeys/(.*)', JSHotKeys),
         (route_prefix + '/init', InitHandler),
     ]
 
-app = webapp2.WSGIApplication(routes, debug=is_local_srv())
+app = profiling.ProfileMiddleware(
+    webapp2.WSGIApplication(routes, debug=is_local_srv()),
+    local=is_local_srv())
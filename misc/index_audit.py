@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+'''Audit index.yaml against the queries we run.
+
+Each query in isrv/ is listed in QUERIES below. For every query we compute the
+index it needs, then report missing indexes, composite indexes in index.yaml
+that no query uses, and the properties each kind is queried on (all other
+properties should be indexed=False).
+
+The tests record every datastore query they run and fail when one is not in
+QUERIES (see unlisted), so the list can't silently drift from the code.
+
+Usage: python misc/index_audit.py [index.yaml]
+Exits with 1 if an index is missing.
+'''
+from __future__ import print_function
+
+from collections import defaultdict, namedtuple
+import sys
+
+import yaml
+
+ASC, DESC = 'asc', 'desc'
+
+Query = namedtuple(
+    'Query', 'where kind ancestor equality inequality orders')
+
+
+def query(where, kind, ancestor=False, equality=(), inequality=None,
+          orders=()):
+    return Query(where, kind, ancestor, tuple(equality), inequality,
+                 tuple(orders))
+
+
+# IN filters count as equality filters, kind '*' is a kindless query
+QUERIES = [
+    query('db.User.from_pub_key', 'User', equality=['pub_key']),
+    query('db.Votable.counts_async', 'UpVote', ancestor=True),
+    query('db.Votable.counts_async', 'DownVote', ancestor=True),
+    query('db.Post.comments', 'Comment', ancestor=True,
+          equality=['published'], orders=[('created', DESC)]),
+    query('db.Post.counts_async(comment_count)', 'Comment', ancestor=True,
+          equality=['published'], orders=[('created', DESC)]),
+    query('db.Post.comments(include_future)', 'Comment', ancestor=True,
+          orders=[('created', DESC)]),
+    query('db.Post.comments(not publishing_migrated)', 'Comment',
+          ancestor=True, inequality='created', orders=[('created', DESC)]),
+    query('db.delete_votes', 'UpVote', ancestor=True, equality=['user']),
+    query('db.delete_votes', 'DownVote', ancestor=True, equality=['user']),
+    query('db.my_votes_async', 'UpVote', ancestor=True, equality=['user']),
+    query('db.my_votes_async', 'DownVote', ancestor=True, equality=['user']),
+    query('db.Channel.from_title', 'Channel', equality=['title']),
+    query('db.Channel.find(count > 0)', 'Post', equality=['channels'],
+          inequality='created', orders=[('created', ASC), ('__key__', ASC)]),
+    query('db.Channel.find(count <= 0)', 'Post', equality=['channels'],
+          inequality='created', orders=[('created', DESC), ('__key__', DESC)]),
+    query('db.Channel.iter_all', 'Channel'),
+    query('db.Pending.due', 'Pending', inequality='publish_at',
+          orders=[('publish_at', ASC)]),
+    query('mapper.SchedulePublishing(Post)', 'Post', inequality='created'),
+    query('mapper.SchedulePublishing(Comment)', 'Comment'),
+    query('db.Update.updates_for', 'Update', equality=['post'],
+          inequality='sort', orders=[('sort', DESC)]),
+    query('db.Update.updates_for(kinds)', 'Update',
+          equality=['post', 'what_kind'], inequality='sort',
+          orders=[('sort', DESC)]),
+    query('db.Update.newest_async', 'Update',
+          equality=['post', 'what_kind'], inequality='sort',
+          orders=[('sort', DESC)]),
+    query('db.Update.compact', 'Update', inequality='sort',
+          orders=[('sort', DESC)]),
+    query('mapper.RePut(Update)', 'Update'),
+    query('mapper.KeyVotes(UpVote)', 'UpVote'),
+    query('mapper.KeyVotes(DownVote)', 'DownVote'),
+    query('db.cascade_delete_batch(children)', '*', ancestor=True),
+    query('db.cascade_delete_batch(updates)', 'Update', equality=['post']),
+    query('db.Flag.flags_for', 'Flag', ancestor=True),
+    query('db.Moderation.undigested', 'Moderation', equality=['digested']),
+    query('webedit.JSFlagged.query', 'Moderation',
+          orders=[('last_flagged', DESC)]),
+    query('mapper.BackfillModeration', 'Flag'),
+    query('idempotency.purge_query', 'IdempotentReply', inequality='created'),
+    query('webedit.edit_users', 'User', inequality='pub_key',
+          orders=[('pub_key', ASC)]),
+    query('webedit.editor_emails', 'Editor'),
+    query('bulk.next_chunk', 'ImportChunk', ancestor=True),
+    query('bulk.export_page', 'Post', orders=[('created', DESC)]),
+    query('webedit.JSPosts.query', 'Post', orders=[('created', DESC)]),
+    query('webedit.JSPosts.post', 'Channel'),
+    query('webedit.JSComments.query', 'Comment', ancestor=True,
+          orders=[('created', DESC)]),
+    query('webedit.JSONHandler.update_votes_cls', 'UpVote', ancestor=True,
+          equality=['user']),
+    query('webedit.JSONHandler.update_votes_cls', 'DownVote', ancestor=True,
+          equality=['user']),
+]
+
+
+def shape(q):
+    '''What identifies a query (equality filters in any order)'''
+    return (q.kind, q.ancestor, frozenset(q.equality), q.inequality, q.orders)
+
+
+def from_pb(pb):
+    '''Query of a datastore_pb.Query (RunQuery request)'''
+    equality, inequality = [], None
+    for filter_pb in pb.filter_list():
+        name = filter_pb.property(0).name()
+        if filter_pb.op() == filter_pb.EQUAL:
+            equality.append(name)
+        else:
+            inequality = name
+    orders = [
+        (order.property(), ASC if order.direction() == order.ASCENDING
+         else DESC)
+        for order in pb.order_list()]
+    return query(None, pb.kind() or '*', pb.has_ancestor(), equality,
+                 inequality, orders)
+
+
+def fmt_query(q):
+    parts = ['ancestor'] if q.ancestor else []
+    parts.extend('{} ='.format(name) for name in q.equality)
+    if q.inequality:
+        parts.append('{} <>'.format(q.inequality))
+    parts.extend('order ' + (name if direction == ASC else '-' + name)
+                 for name, direction in q.orders)
+    return '{} ({})'.format(q.kind, ', '.join(parts))
+
+
+def unlisted(queries):
+    '''Queries (see from_pb) which are not in QUERIES'''
+    listed = set(shape(q) for q in QUERIES)
+    return [q for q in queries if shape(q) not in listed]
+
+
+def required_index(q):
+    '''Composite index needed by q as (kind, ancestor, props) or None if
+    built-in indexes are enough.'''
+    orders = list(q.orders)
+    # Default sort order of an index is by key
+    while orders and orders[-1] == ('__key__', ASC):
+        orders.pop()
+
+    sorted_props = set(name for name, _ in orders)
+    props = set(q.equality) | sorted_props
+    if q.inequality:
+        props.add(q.inequality)
+
+    # Kind, ancestor or equality only queries are served by merge join
+    if not (q.inequality or orders):
+        return None
+
+    # Single property filter/sort
+    if not (q.ancestor or q.equality) and len(props) == 1:
+        return None
+
+    index = [(name, ASC) for name in q.equality]
+    if q.inequality and q.inequality not in sorted_props:
+        index.append((q.inequality, ASC))
+    index.extend(orders)
+    return (q.kind, q.ancestor, tuple(index))
+
+
+def load_indexes(path):
+    with open(path) as fo:
+        data = yaml.safe_load(fo) or {}
+
+    indexes = []
+    for idx in data.get('indexes') or []:
+        props = tuple(
+            (prop['name'], prop.get('direction', ASC))
+            for prop in idx.get('properties', []))
+        ancestor = idx.get('ancestor', False) in (True, 'yes')
+        indexes.append((idx['kind'], ancestor, props))
+    return indexes
+
+
+def same_index(required, existing, neq):
+    '''Equality properties (first neq) may appear in any order in an index'''
+    if required[:2] != existing[:2]:
+        return False
+    req, exs = required[2], existing[2]
+    return set(req[:neq]) == set(exs[:neq]) and req[neq:] == exs[neq:]
+
+
+def fmt_index(index):
+    kind, ancestor, props = index
+    props = ', '.join(
+        name if direction == ASC else '-' + name for name, direction in props)
+    return '{}{} ({})'.format(kind, ' [ancestor]' if ancestor else '', props)
+
+
+def main(path):
+    existing = load_indexes(path)
+    used = set()
+    missing = []
+    queried = defaultdict(set)
+
+    print('Queries:')
+    for q in QUERIES:
+        queried[q.kind].update(q.equality)
+        if q.inequality:
+            queried[q.kind].add(q.inequality)
+        queried[q.kind].update(name for name, _ in q.orders)
+
+        req = required_index(q)
+        if req is None:
+            print('  {:45} built-in'.format(q.where))
+            continue
+
+        match = [idx for idx in existing
+                 if same_index(req, idx, len(q.equality))]
+        used.update(match)
+        status = 'ok' if match else 'MISSING'
+        if not match:
+            missing.append(req)
+        print('  {:45} {} {}'.format(q.where, fmt_index(req), status))
+
+    print('\nUnused indexes in {}:'.format(path))
+    for idx in existing:
+        if idx not in used:
+            print('  ' + fmt_index(idx))
+
+    print('\nQueried properties (everything else can be indexed=False):')
+    queried.pop('*', None)
+    for kind in sorted(queried):
+        props = sorted(queried[kind] - set(['__key__']))
+        print('  {:10} {}'.format(kind, ', '.join(props) or '-'))
+
+    return 1 if missing else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1] if len(sys.argv) > 1 else 'index.yaml'))
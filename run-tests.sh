@@ -1,9 +1,6 @@
 #!/bin/bash
-
-if [ -z "$(pgrep -f dev_appserver)" ]; then
-    echo "error: local server not running, see run-local.sh"
-    exit 1
-fi
+# Tests run in-process with the App Engine testbed stubs, set GAE_SDK if the
+# SDK is not in /opt/google_appengine
 
 # Fail on 1st error
 
@@ -12,4 +9,4 @@ if [ -n "$(which flake8)" ]; then
     flake8 tests || exit 1
 fi
 
-PYTHONPATH=${PWD} python2 tests/test_api.py -v $@
+cd tests && PYTHONPATH=${PWD}/.. python2 -m unittest discover -p 'test_*.py' -v $@
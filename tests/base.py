@@ -0,0 +1,140 @@
+'''Test helpers: App Engine testbed stubs and in-process WSGI requests.
+
+Set GAE_SDK if the SDK is not in /opt/google_appengine.
+'''
+from os import environ
+from os.path import abspath, dirname, join
+import json
+import sys
+import unittest
+
+root = dirname(dirname(abspath(__file__)))
+sdk = environ.get('GAE_SDK', '/opt/google_appengine')
+
+
+def fix_sys_path():
+    if sdk not in sys.path:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    if root not in sys.path:
+        sys.path.insert(0, root)
+
+
+fix_sys_path()
+
+from google.appengine.api import apiproxy_stub_map  # noqa
+from google.appengine.api import datastore  # noqa
+from google.appengine.datastore import datastore_stub_util  # noqa
+from google.appengine.ext import ndb  # noqa
+from google.appengine.ext import testbed  # noqa
+import webapp2  # noqa
+
+from isrv import api, db, webedit  # noqa
+
+sys.path.insert(0, join(root, 'misc'))
+import index_audit  # noqa
+
+editor_email = 'editor@example.com'
+
+
+class TestCase(unittest.TestCase):
+    '''Test with fresh datastore, memcache, task queue and mail stubs'''
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(
+            USER_EMAIL=editor_email,
+            USER_ID='1',
+            USER_IS_ADMIN='1',
+            overwrite=True,
+        )
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        # Queries fail if index.yaml does not have their index
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=policy, require_indexes=True, root_path=root)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=root)
+        self.testbed.init_user_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.taskqueue = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        self.mail = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        self.queries = []
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'test-queries', self.record_query, 'datastore_v3')
+
+        # In-process caches outlive the stubs
+        db.User.epoch_cache.invalidate()
+        db.Channel.cache.invalidate()
+        del db._token_secret[:]
+        webedit.editor_cache.invalidate()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+        missing = set(index_audit.fmt_query(q)
+                      for q in index_audit.unlisted(self.queries))
+        self.assertFalse(
+            missing, 'queries not in misc/index_audit.py QUERIES: {}'.format(
+                ', '.join(sorted(missing))))
+
+    def record_query(self, service, call, request, response):
+        if call == 'RunQuery':
+            self.queries.append(index_audit.from_pb(request))
+
+    def request(self, method, path, body=None, headers=None, app=None):
+        '''Response of request to app (api.app by default)'''
+        req = webapp2.Request.blank(path, headers=headers or {})
+        req.method = method
+        if body is not None:
+            req.body = body if isinstance(body, str) else json.dumps(body)
+        # New request, new context cache (like on App Engine)
+        ndb.get_context().clear_cache()
+        return req.get_response(app or api.app)
+
+    def json_request(self, method, path, body=None, token=None,
+                     status=200, app=None):
+        '''Reply JSON of request, fails if response status is not status'''
+        headers = {'Authorization': token} if token else {}
+        resp = self.request(method, path, body, headers, app)
+        self.assertEqual(resp.status_int, status, resp.body)
+        return json.loads(resp.body) if status == 200 else None
+
+    def new_user(self, pub_key='pub key'):
+        '''(user, session token) of a new user'''
+        user = db.User.create(pub_key)
+        return user, user.login()
+
+    def new_channel(self, title='channel'):
+        return db.encode_key(db.Channel.create(title).key)
+
+    def new_post(self, user, channels, content='content', created=None):
+        return db.Post.create(user, content, 'theme', 'bg', channels, 'role',
+                              'role text', created)
+
+    def make_editor(self):
+        webedit.Editor(email=editor_email).put()
+        webedit.invalidate_editor_cache()
+
+    def tasks(self, url=None):
+        tasks = self.taskqueue.get_filtered_tasks()
+        return [task for task in tasks if url is None or task.url == url]
+
+    def run_tasks(self, url=None, limit=100):
+        '''Run queued tasks (of url) until there are none, returns count'''
+        count = 0
+        while count < limit:
+            tasks = self.tasks(url)
+            if not tasks:
+                return count
+            # Stub tasks have no queue_name, all tasks use the default queue
+            task = tasks[0]
+            self.taskqueue.DeleteTask('default', task.name)
+            resp = self.request(
+                task.method, task.url, task.payload,
+                dict(task.headers, **{'X-Appengine-QueueName': 'default'}))
+            self.assertEqual(resp.status_int, 200, resp.body)
+            count += 1
+        self.fail('too many tasks')
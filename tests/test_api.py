@@ -0,0 +1,297 @@
+#!/usr/bin/env python2
+'''API handler tests (run with run-tests.sh)'''
+from datetime import datetime, timedelta
+import json
+import unittest
+
+from base import TestCase, db, webedit
+from isrv import api, coalesce, mapper
+
+
+class FieldsTest(TestCase):
+    def setUp(self):
+        super(FieldsTest, self).setUp()
+        self.user, self.token = self.new_user()
+        self.chan = self.new_channel()
+        self.post = self.new_post(self.user, [self.chan])
+        self.key = db.encode_key(self.post.key)
+
+    def test_all_fields(self):
+        reply = self.json_request(
+            'GET', '/api/v1/posts/' + self.key, token=self.token)
+        post = reply['post']
+        self.assertEqual(post['key'], self.key)
+        self.assertEqual(post['content'], 'content')
+        self.assertEqual(post['channels'], [self.chan])
+        self.assertEqual(post['comment_count'], 0)
+        self.assertEqual(post['upvote_count'], 0)
+        # Not in json_attrs
+        self.assertNotIn('uid_map', post)
+        self.assertNotIn('hidden', post)
+
+    def test_selected_fields(self):
+        reply = self.json_request(
+            'GET', '/api/v1/posts/{}?fields=content,upvote_count'.format(
+                self.key), token=self.token)
+        self.assertEqual(
+            set(reply['post']), set(['key', 'content', 'upvote_count']))
+
+    def test_serializer_renames(self):
+        comment = db.Comment.create(
+            self.post, self.user, 'comment', 'role', 'role text')
+        obj = db.serializer_for(db.Comment)(comment)
+        self.assertEqual(obj['icon'], 0)  # Post creator is post user 0
+        self.assertNotIn('user', obj)
+
+
+class VotesTest(TestCase):
+    def setUp(self):
+        super(VotesTest, self).setUp()
+        self.user, self.token = self.new_user()
+        post = self.new_post(self.user, [self.new_channel()])
+        self.path = '/api/v1/votes/{}/'.format(db.encode_key(post.key))
+
+    def vote(self, method, direction):
+        reply = self.json_request(method, self.path + direction,
+                                  token=self.token)
+        return reply['upvote_count'], reply['downvote_count']
+
+    def test_counts(self):
+        self.assertEqual(self.vote('POST', 'up'), (1, 0))
+        # Replaces the up vote
+        self.assertEqual(self.vote('POST', 'down'), (0, 1))
+        self.assertEqual(self.vote('DELETE', 'down'), (0, 0))
+
+
+class MyVotesTest(TestCase):
+    def setUp(self):
+        super(MyVotesTest, self).setUp()
+        self.user, self.token = self.new_user()
+        other, _ = self.new_user('other')
+        self.post = self.new_post(other, [self.new_channel()])
+        self.comment = db.Comment.create(
+            self.post, other, 'comment', 'role', 'role text')
+        self.keys = [db.encode_key(obj.key)
+                     for obj in [self.post, self.comment]]
+        self.addCleanup(setattr, db, 'votes_keyed', False)
+
+    def vote(self, key, direction):
+        self.json_request('POST', '/api/v1/votes/{}/{}'.format(key, direction),
+                          token=self.token)
+
+    def my_votes(self):
+        path = '/api/v1/myvotes/?' + '&'.join('key=' + key
+                                              for key in self.keys)
+        votes = self.json_request('GET', path, token=self.token)['votes']
+        return [votes[key] for key in self.keys]
+
+    def test_by_key(self):
+        db.votes_keyed = True
+        self.vote(self.keys[0], 'up')
+        self.vote(self.keys[0], 'up')  # Overwrites the vote
+        self.vote(self.keys[1], 'down')
+        self.assertEqual(self.post.key.get().to_dict()['upvote_count'], 1)
+
+        del self.queries[:]
+        self.assertEqual(self.my_votes(), ['up', 'down'])
+        self.assertEqual(self.queries, [])
+
+    def test_legacy_votes(self):
+        uid = db.post_user(self.post, self.user)
+        seeded = [db.UpVote(user=uid, parent=self.post.key) for _ in range(2)]
+        db.ndb.put_multi(seeded + [db.DownVote(user=uid,
+                                               parent=self.comment.key)])
+        self.assertEqual(self.my_votes(), ['up', 'down'])
+
+        for cls in [db.UpVote, db.DownVote]:
+            for _ in range(2):  # Re-runs change nothing
+                mapper.KeyVotes(cls).run()
+        db.votes_keyed = True
+        self.assertEqual(self.my_votes(), ['up', 'down'])
+        counts = self.post.key.get().to_dict()
+        self.assertEqual((counts['upvote_count'], counts['downvote_count']),
+                         (2, 1))
+
+
+class BatchTest(TestCase):
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        self.user, self.token = self.new_user()
+        self.chan = self.new_channel()
+        chan = db.decode_key(self.chan).get()
+        self.posts = [
+            self.new_post(self.user, [self.chan], 'post {}'.format(i))
+            for i in range(3)]
+        for post in self.posts:
+            comment = db.Comment.create(
+                post, self.user, 'comment', 'role', 'role text')
+            db.Update.create(chan, comment.key, datetime.now())
+        keys = '&'.join('key=' + db.encode_key(post.key)
+                        for post in self.posts)
+        self.paths = [
+            '/channels/',
+            '/channels/{}?count=2'.format(self.chan),
+            '/posts/' + db.encode_key(self.posts[0].key),
+            '/comments/' + db.encode_key(self.posts[1].key),
+            '/items/?' + keys,
+            '/updates/?' + keys,
+            '/posts/' + db.encode_key(db.ndb.Key('Post', 1)),  # Not found
+        ]
+
+    def batch(self, paths):
+        reply = self.json_request(
+            'POST', '/api/v1/batch',
+            {'requests': [{'path': path} for path in paths]}, self.token)
+        return reply['responses']
+
+    def test_same_as_requests(self):
+        responses = self.batch(self.paths)
+        for path, resp in zip(self.paths, responses):
+            single = self.request('GET', '/api/v1' + path,
+                                  headers={'Authorization': self.token})
+            self.assertEqual(resp['status'], single.status_int, path)
+            if single.status_int != 200:
+                continue
+            body = json.loads(single.body)
+            if path.startswith('/updates/'):
+                # Sample time
+                del body['hash'], resp['body']['hash']
+            self.assertEqual(resp['body'], body, path)
+
+    def test_concurrent(self):
+        # Updates are queried while the feed waits for its channel and cache
+        # (a blocking feed handler would query posts first)
+        self.batch(self.paths[1:2] + self.paths[5:6])
+        kinds = [query.kind for query in self.queries]
+        self.assertLess(kinds.index('Update'), kinds.index('Post'))
+
+    def test_no_nested_batch(self):
+        self.assertEqual(self.batch(['/batch'])[0]['status'], 405)
+
+
+class FlagTest(TestCase):
+    def setUp(self):
+        super(FlagTest, self).setUp()
+        self.user, self.token = self.new_user()
+        self.post = self.new_post(self.user, [self.new_channel()])
+        self.key = db.encode_key(self.post.key)
+        self.cron = {'X-Appengine-Cron': 'true'}
+
+    def flag(self, key, count=1):
+        for _ in range(count):
+            self.json_request('POST', '/api/v1/flag/' + key, token=self.token)
+
+    def digest(self):
+        resp = self.request('GET', api.flag_digest_task_url,
+                            headers=self.cron)
+        self.assertEqual(resp.status_int, 200, resp.body)
+        return json.loads(resp.body)['count']
+
+    def test_digest(self):
+        self.flag(self.key, db.flag_hide_threshold)
+        self.assertEqual(self.digest(), 1)
+        messages = self.mail.get_sent_messages()
+        self.assertEqual(len(messages), 1)
+        self.assertIn('Post {} flagged {} times (hidden)'.format(
+            self.key, db.flag_hide_threshold), messages[0].body.decode())
+        self.assertTrue(self.post.key.get().hidden)
+
+        # Nothing new, no mail
+        self.assertEqual(self.digest(), 0)
+        self.assertEqual(len(self.mail.get_sent_messages()), 1)
+        self.flag(self.key)
+        self.assertEqual(self.digest(), 1)
+
+    def test_contended(self):
+        def contended(key, time):
+            raise db.datastore_errors.TransactionFailedError()
+
+        self.addCleanup(setattr, db.Flag, 'create', db.Flag.__dict__['create'])
+        db.Flag.create = staticmethod(contended)
+        self.flag(self.key, db.flag_hide_threshold)
+        self.assertIsNone(db.Moderation.key_for(self.post.key).get())
+
+        # Tasks of a burst count all of its flags
+        self.assertEqual(self.run_tasks(api.recount_flags_task_url),
+                         db.flag_hide_threshold)
+        mod = db.Moderation.key_for(self.post.key).get()
+        self.assertEqual(mod.count, db.flag_hide_threshold)
+        self.assertTrue(self.post.key.get().hidden)
+        self.assertEqual(self.digest(), 1)
+
+    def test_flagged_during_digest(self):
+        self.flag(self.key)
+        mods = db.Moderation.undigested()
+        db.Flag.create(self.post.key, datetime.now())
+        self.assertEqual(db.Moderation.mark_digested(mods), 0)
+        self.assertEqual(len(db.Moderation.undigested()), 1)
+
+    def test_flagged_channel(self):
+        self.make_editor()
+        chan = self.new_channel('other')
+        self.flag(chan)
+        reply = self.json_request('GET', '/_we/js/flagged/', app=webedit.app)
+        self.assertEqual(reply['items'][0]['what'], chan)
+        self.assertIsNone(reply['items'][0]['hidden'])
+
+    def test_old_flag_task(self):
+        resp = self.request(
+            'POST', api.flag_task_url, 'key=' + self.key,
+            {'X-Appengine-QueueName': 'default',
+             'Content-Type': 'application/x-www-form-urlencoded'})
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(self.mail.get_sent_messages(), [])
+
+
+class PrefetchTest(TestCase):
+    def setUp(self):
+        super(PrefetchTest, self).setUp()
+        self.user, self.token = self.new_user()
+        self.chan = self.new_channel()
+        start = datetime.now() - timedelta(hours=1)
+        for i in range(6):
+            self.new_post(self.user, [self.chan], 'post {}'.format(i),
+                          start + timedelta(minutes=i))
+
+    def page(self, hash=None):
+        path = '/api/v1/channels/{}?count=-2&prefetch=1'.format(self.chan)
+        if hash:
+            path += '&hash=' + hash
+        updates = self.json_request('GET', path, token=self.token)['updates']
+        self.assertEqual(len(updates), 2)
+        return updates[-1]['hash']
+
+    def test_once(self):
+        next_hash = self.page()
+        self.page()  # Cached, next page already claimed
+        self.assertEqual(len(self.tasks(api.prefetch_feed_task_url)), 1)
+        self.assertEqual(self.run_tasks(api.prefetch_feed_task_url), 1)
+
+        # Prefetched page is used, its next page is prefetched
+        self.assertNotEqual(self.page(next_hash), next_hash)
+        self.assertEqual(len(self.tasks(api.prefetch_feed_task_url)), 1)
+
+    def test_next_page_cached(self):
+        first = self.page()
+        self.taskqueue.FlushQueue('default')
+        coalesce.memcache.flush_all()
+        self.page(first)
+        self.taskqueue.FlushQueue('default')
+        self.page()
+        self.assertEqual(self.tasks(api.prefetch_feed_task_url), [])
+
+    def test_prefetched_time(self):
+        key = coalesce.cache_key('test')
+        self.assertTrue(coalesce.prefetch(key, lambda: 'value'))
+        prefetch_key = coalesce.prefetch_prefix + key
+        computed = coalesce.memcache.get(prefetch_key)[0] - 10
+        coalesce.memcache.set(prefetch_key, (computed, 'value'))
+
+        self.assertEqual(coalesce.get(key, None, ttl=5), 'value')
+        self.assertEqual(coalesce.memcache.get(key), (computed, 'value'))
+        # Older than ttl, computed again
+        self.assertEqual(coalesce.get(key, lambda: 'new', ttl=5), 'new')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python2
+'''Bulk import/export tests (run with run-tests.sh)'''
+import json
+import unittest
+
+from base import TestCase, db, webedit
+from isrv import api, bulk
+
+
+def ndjson(items):
+    return '\n'.join(json.dumps(item) for item in items)
+
+
+class BulkTest(TestCase):
+    def setUp(self):
+        super(BulkTest, self).setUp()
+        self.make_editor()
+        self.chan = self.new_channel()
+        self.items = [self.item(i) for i in range(3)]
+
+    def item(self, num):
+        return {
+            'content': 'post {}'.format(num),
+            'theme': 'theme',
+            'background': 'bg',
+            'role': 'role',
+            'role_text': 'role text',
+            'channels': [self.chan],
+            'created': '2020-01-0{}T00:00:00Z'.format(num + 1),
+            'upvote_count': 2,
+            'comments': [{
+                'content': 'comment {}'.format(num),
+                'role': 'role',
+                'role_text': 'role text',
+                'created': '2020-02-01T00:00:00Z',
+                'downvote_count': 1,
+            }],
+        }
+
+    def export(self):
+        resp = self.request('GET', '/_we/js/export/?count=100',
+                            app=webedit.app)
+        self.assertEqual(resp.status_int, 200, resp.body)
+        return [json.loads(line) for line in resp.body.splitlines()]
+
+    def test_import_export(self):
+        resp = self.request('POST', '/_we/js/import/', ndjson(self.items),
+                            app=webedit.app)
+        self.assertEqual(resp.status_int, 200, resp.body)
+        self.assertEqual(json.loads(resp.body)['count'], 3)
+        self.run_tasks(api.import_task_url)
+
+        posts = self.export()
+        self.assertEqual([post['content'] for post in posts],
+                         ['post 2', 'post 1', 'post 0'])
+        for post in posts:
+            self.assertEqual(post['channels'], [self.chan])
+            self.assertEqual(post['upvote_count'], 2)
+            self.assertEqual(post['comment_count'], 1)
+            self.assertEqual(post['comments'][0]['downvote_count'], 1)
+
+    def test_retried_chunk(self):
+        users = webedit.cached_edit_users()
+        for _ in range(2):
+            count = bulk.import_items(
+                self.items, users, webedit.edit_str2dt, None, 'job-chunk')
+            self.assertEqual(count, 3)
+
+        posts = self.export()
+        self.assertEqual(len(posts), 3)
+        self.assertEqual([post['upvote_count'] for post in posts], [2] * 3)
+        self.assertEqual([post['comment_count'] for post in posts], [1] * 3)
+
+    def test_bad_channel(self):
+        user, _ = self.new_user()
+        self.items[1]['channels'] = [db.encode_key(user.key)]
+        self.items[2]['channels'] = ['no such channel']
+        resp = self.request('POST', '/_we/js/import/', ndjson(self.items),
+                            app=webedit.app)
+        self.assertEqual(resp.status_int, 400)
+        self.assertIn('line 2: bad channel', resp.body)
+        self.assertEqual(self.tasks(api.import_task_url), [])
+
+    def test_unknown_channel(self):
+        known = set([self.chan])
+        bulk.parse_lines(ndjson(self.items).splitlines(), known)
+        with self.assertRaises(ValueError):
+            bulk.parse_lines(ndjson(self.items).splitlines(), set())
+
+    def test_bad_values(self):
+        bad = [
+            ('upvote_count', 'many'),
+            ('downvote_count', bulk.max_votes + 1),
+            ('upvote_count', -1),
+            ('content', {'text': 'post'}),
+            ('created', 20200101),
+        ]
+        for name, value in bad:
+            self.items[1][name] = value
+            with self.assertRaises(ValueError) as ctx:
+                bulk.parse_lines(ndjson(self.items).splitlines())
+            self.assertEqual(str(ctx.exception), 'line 2: bad ' + name)
+            del self.items[1][name]
+            self.items[1].update(self.item(1))
+
+        self.items[2]['comments'][0]['role_text'] = None
+        resp = self.request('POST', '/_we/js/import/', ndjson(self.items),
+                            app=webedit.app)
+        self.assertEqual(resp.status_int, 400)
+        self.assertIn('line 3: bad comments.role_text', resp.body)
+        self.assertEqual(self.tasks(api.import_task_url), [])
+
+        for line in ['[]', '{"comments": "none"}']:
+            with self.assertRaises(ValueError):
+                bulk.parse_lines([line])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python2
+'''Cache coalescing tests (run with run-tests.sh)'''
+import threading
+import unittest
+
+from base import TestCase, ndb
+from isrv import coalesce
+
+
+class CoalesceTest(TestCase):
+    def test_tasklets_share_load(self):
+        loads = []
+
+        @ndb.tasklet
+        def load_async():
+            loads.append(1)
+            yield ndb.sleep(0.01)
+            raise ndb.Return('value')
+
+        key = coalesce.cache_key('test')
+        futures = [coalesce.get_async(key, load_async, 5) for _ in range(3)]
+        self.assertEqual([future.get_result() for future in futures],
+                         ['value'] * 3)
+        self.assertEqual(len(loads), 1)
+        # Done futures are not shared, next get is a cache hit
+        future = coalesce.get_async(key, load_async, 5)
+        self.assertIsNot(future, futures[0])
+        self.assertEqual(future.get_result(), 'value')
+        self.assertEqual(len(loads), 1)
+
+    def test_threads_need_each_others_keys(self):
+        self.addCleanup(setattr, coalesce, 'wait_timeout',
+                        coalesce.wait_timeout)
+        coalesce.wait_timeout = 0.2
+        keys = coalesce.cache_key('x'), coalesce.cache_key('y')
+        started = [threading.Event(), threading.Event()]
+        results = {}
+
+        def run(i):
+            def load():
+                # Both threads computing, each needs the other's key
+                started[i].set()
+                started[1 - i].wait(1)
+                return coalesce.get(keys[1 - i], lambda: 'inner', 5)
+
+            results[i] = coalesce.get(keys[i], load, 5)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in [0, 1]]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(results, {0: 'inner', 1: 'inner'})
+
+
+if __name__ == '__main__':
+    unittest.main()
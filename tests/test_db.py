@@ -0,0 +1,276 @@
+#!/usr/bin/env python2
+'''Model tests (run with run-tests.sh)'''
+from datetime import datetime, timedelta
+from os.path import join
+import unittest
+
+from base import TestCase, datastore, db, ndb, root
+from isrv import api, mapper
+
+
+class PostUsersTest(TestCase):
+    def setUp(self):
+        super(PostUsersTest, self).setUp()
+        self.user, _ = self.new_user()
+        self.other, _ = self.new_user('other')
+        self.post = self.new_post(self.user, [self.new_channel()])
+
+    def test_creator_is_zero(self):
+        self.assertEqual(db.post_user(self.post, self.user), 0)
+        uid = db.post_user(self.post, self.other)
+        self.assertNotEqual(uid, 0)
+        self.assertEqual(db.post_user(self.post, self.other), uid)
+
+    def test_migrate_stale_post(self):
+        self.post.uid_map = {self.user.uid(): 0}
+        self.post.put()
+        stale = self.post.key.get(use_cache=False)
+        # Uid added after stale was read
+        self.post.uid_map[self.other.uid()] = 7
+        self.post.put()
+
+        ndb.transaction(lambda: db.migrate_post_users(stale))
+        pusers = db.PostUsers.key_for(self.post.key).get()
+        self.assertEqual(
+            pusers.uid_map, {self.user.uid(): 0, self.other.uid(): 7})
+        self.assertIsNone(self.post.key.get().uid_map)
+        self.assertEqual(db.post_user(stale, self.other), 7)
+
+
+class TokenTest(TestCase):
+    def setUp(self):
+        super(TokenTest, self).setUp()
+        self.user, self.token = self.new_user()
+
+    def valid(self, token):
+        return db.User.from_token(token) is not None
+
+    def login_elsewhere(self, set_memcache=True):
+        '''Login on another instance (this one has the old epoch cached)'''
+        epoch = db._next_token_epoch(self.user.key)
+        if set_memcache:
+            db.memcache.set(
+                db.epoch_key_prefix + self.user.key.urlsafe(), epoch)
+        return db.make_token(self.user.key, epoch)
+
+    def test_login_revokes(self):
+        self.assertTrue(self.valid(self.token))
+        token = self.user.login()
+        self.assertTrue(self.valid(token))
+        self.assertFalse(self.valid(self.token))
+
+    def test_login_on_other_instance(self):
+        self.assertTrue(self.valid(self.token))  # Epoch cached
+        token = self.login_elsewhere()
+        self.assertTrue(self.valid(token))
+        self.assertFalse(self.valid(self.token))
+
+    def test_memcache_missed_login(self):
+        self.assertTrue(self.valid(self.token))
+        token = self.login_elsewhere(set_memcache=False)
+        self.assertTrue(self.valid(token))
+
+    def test_legacy_token(self):
+        user = db.User.create('legacy')
+        token = db.encode_key(db.Token(parent=user.key).put())
+        self.assertTrue(self.valid(token))
+        user.login()
+        self.assertFalse(self.valid(token))
+
+    def test_bad_token(self):
+        self.assertFalse(self.valid(self.token[:-2] + 'xx'))
+
+
+class UpdatesTest(TestCase):
+    def setUp(self):
+        super(UpdatesTest, self).setUp()
+        self.user, _ = self.new_user()
+        self.chan = db.Channel.create('chan')
+        chan_key = db.encode_key(self.chan.key)
+        self.posts = [self.new_post(self.user, [chan_key]) for i in range(2)]
+        self.comment = db.Comment.create(
+            self.posts[0], self.user, 'comment', 'role', 'role text')
+
+    def update(self, obj, minutes):
+        created = datetime(2020, 1, 1) + timedelta(minutes=minutes)
+        db.Update.create(self.chan, obj.key, created)
+
+    def test_updates_for(self):
+        self.update(self.posts[0], 0)
+        self.update(self.comment, 1)
+        self.update(self.comment, 2)
+        self.update(self.posts[1], 3)
+
+        updates = list(db.Update.updates_for(
+            [post.key for post in self.posts], datetime(2020, 1, 1)))
+        # Newest first, one per object
+        self.assertEqual(
+            [(update.what, update.created.minute) for update in updates],
+            [(self.posts[1].key, 3), (self.comment.key, 2),
+             (self.posts[0].key, 0)])
+
+        updates = list(db.Update.updates_for(
+            [self.posts[0].key], datetime(2020, 1, 1), kinds=['Comment']))
+        self.assertEqual([update.what for update in updates],
+                         [self.comment.key])
+
+    def test_newest(self):
+        self.update(self.comment, 1)
+        self.update(self.comment, 5)
+        self.update(self.posts[0], 9)
+        newest = db.Update.newest_async(
+            self.posts[0].key, 'Comment').get_result()
+        self.assertEqual(newest.created.minute, 5)
+
+    def test_compact(self):
+        for minutes in range(4):
+            self.update(self.comment, minutes)
+            self.update(self.posts[1], minutes)
+        self.update(self.posts[0], 0)
+        self.update(self.posts[0], 10)
+
+        before = datetime(2020, 1, 1, 0, 5)
+        deleted, batches, cur, more = 0, 0, None, True
+        while more:
+            count, cur, more = db.Update.compact(before, cur, batch_size=4)
+            deleted += count
+            batches += 1
+        # 9 updates before `before`, at least a batch per shard
+        self.assertGreaterEqual(batches, db.update_shards)
+
+        # Newest update per (post, what_kind) stays even if old
+        self.assertEqual(deleted, 7)
+        updates = db.Update.updates_for(
+            [post.key for post in self.posts], datetime(2020, 1, 1))
+        left = sorted((update.what, update.created.minute)
+                      for update in updates)
+        self.assertEqual(left, sorted([
+            (self.posts[0].key, 10), (self.posts[1].key, 3),
+            (self.comment.key, 3)]))
+
+    def test_compact_tasks(self):
+        for minutes in range(3):
+            self.update(self.comment, minutes)
+        resp = self.request('GET', api.compact_task_url,
+                            headers={'X-Appengine-Cron': 'true'})
+        self.assertEqual(resp.status_int, 200, resp.body)
+        # A task per shard, the last one logs the totals
+        self.assertEqual(self.run_tasks(api.compact_task_url),
+                         db.update_shards)
+        updates = db.Update.updates_for(
+            [self.posts[0].key], datetime(2020, 1, 1))
+        self.assertEqual([update.created.minute for update in updates], [2])
+
+    def test_index_entries(self):
+        with open(join(root, 'index.yaml')) as fo:
+            composites = sum(1 for line in fo
+                             if line.strip() == '- kind: Update')
+        self.assertEqual(db.update_composite_indexes, composites)
+        # Kind, sort, what_kind and post plus 2 composite indexes
+        self.assertEqual(
+            db.index_entries(db.Update, db.update_composite_indexes),
+            1 + 2 * 3 + 2)
+
+    def test_shards(self):
+        # Newer update in a lower shard, results are merged by created
+        for shard, minutes in [(3, 1), (0, 2)]:
+            created = datetime(2020, 1, 1) + timedelta(minutes=minutes)
+            db.Update(created=created, sort=db.sort_key(shard, created),
+                      what=self.comment.key, what_kind='Comment',
+                      post=self.posts[0].key, channel=self.chan.key).put()
+        self.update(self.posts[0], 0)
+
+        newest = db.Update.newest_async(
+            self.posts[0].key, 'Comment').get_result()
+        self.assertEqual(newest.created.minute, 2)
+        key = db.Update.newest_async(
+            self.posts[0].key, 'Comment', keys_only=True).get_result()
+        self.assertEqual(key, newest.key)
+
+        updates = db.Update.updates_for(
+            [self.posts[0].key], datetime(2020, 1, 1))
+        self.assertEqual(
+            [(update.what, update.created.minute) for update in updates],
+            [(self.comment.key, 2), (self.posts[0].key, 0)])
+
+    def test_legacy_update(self):
+        '''Update written before sort, found after it's re-put'''
+        entity = datastore.Entity('Update')
+        entity.update({
+            'created': datetime(2020, 1, 1),
+            'what_kind': 'Comment', 'post': self.posts[0].key.to_old_key()})
+        entity['what'] = self.comment.key.to_old_key()
+        datastore.Put(entity)
+        since = datetime(2020, 1, 1)
+        self.assertEqual(db.Update.updates_for([self.posts[0].key], since), [])
+
+        mapper.RePut(db.Update).run()
+        updates = db.Update.updates_for([self.posts[0].key], since)
+        self.assertEqual([update.what for update in updates],
+                         [self.comment.key])
+        self.assertFalse(db.Update.created._indexed)
+
+
+class SchedulingTest(TestCase):
+    def setUp(self):
+        super(SchedulingTest, self).setUp()
+        self.user, _ = self.new_user()
+        self.chan = db.Channel.create('chan')
+        self.chan_key = db.encode_key(self.chan.key)
+        self.post = self.new_post(self.user, [self.chan_key])
+        self.future = datetime.now() + timedelta(days=1)
+        self.addCleanup(setattr, db, 'publishing_migrated', False)
+
+    def legacy(self, kind, parent, **props):
+        '''Entity written before scheduling (no published property)'''
+        entity = datastore.Entity(kind, parent=parent.to_old_key())
+        entity.update(props)
+        return ndb.Key.from_old_key(datastore.Put(entity))
+
+    def legacy_post(self, created):
+        return self.legacy('Post', self.user.key, content='legacy',
+                           channels=[self.chan_key], created=created)
+
+    def comments(self):
+        return [comment.key for comment in self.post.comments()]
+
+    def feed(self):
+        newer = self.chan.find(datetime(2020, 1, 1), None, 10)
+        older = self.chan.find(self.future, None, -10)
+        return [post.key for post in newer], [post.key for post in older]
+
+    def migrate(self):
+        for kind in [db.Post, db.Comment]:
+            mapper.SchedulePublishing(kind).run()
+        db.publishing_migrated = True
+
+    def test_legacy_comment(self):
+        key = self.legacy('Comment', self.post.key, content='legacy', user=1,
+                          created=datetime.now() - timedelta(minutes=1))
+        self.assertEqual(self.comments(), [key])
+        self.assertEqual(self.post.to_dict()['comment_count'], 1)
+
+        self.migrate()
+        self.assertEqual(self.comments(), [key])
+
+    def test_legacy_future_post(self):
+        key = self.legacy_post(self.future)
+        self.assertEqual(self.feed(), ([self.post.key], [self.post.key]))
+
+        self.migrate()
+        self.assertEqual(self.feed(), ([self.post.key], [self.post.key]))
+        self.assertEqual(key.get().scheduled_channels, [self.chan_key])
+
+    def test_scheduled(self):
+        post = self.new_post(self.user, [self.chan_key], created=self.future)
+        db.Comment.create(self.post, self.user, 'later', 'role', 'role text',
+                          self.future)
+        for migrated in [False, True]:
+            db.publishing_migrated = migrated
+            self.assertEqual(self.comments(), [])
+            self.assertEqual(self.feed(), ([self.post.key], [self.post.key]))
+        self.assertEqual(post.all_channels(), [self.chan_key])
+
+
+if __name__ == '__main__':
+    unittest.main()
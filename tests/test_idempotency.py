@@ -0,0 +1,56 @@
+#!/usr/bin/env python2
+'''Idempotent write request tests (run with run-tests.sh)'''
+import unittest
+
+from base import TestCase, db
+from isrv import idempotency
+
+
+class IdempotentTest(TestCase):
+    def setUp(self):
+        super(IdempotentTest, self).setUp()
+        self.user, self.token = self.new_user()
+        self.post = self.new_post(self.user, [self.new_channel()])
+        self.path = '/api/v1/comments/' + db.encode_key(self.post.key)
+        self.body = {'content': 'comment', 'role': 'role', 'role_text': 'rt'}
+
+    def comments(self):
+        reply = self.json_request('GET', self.path, token=self.token)
+        return reply['comments']
+
+    def test_rid(self):
+        # JSON body without content type, must not be read as a form
+        first = self.json_request(
+            'POST', self.path + '?rid=1', self.body, self.token)
+        again = self.json_request(
+            'POST', self.path + '?rid=1', self.body, self.token)
+        self.assertEqual(first, again)
+        self.assertEqual(len(self.comments()), 1)
+        self.assertEqual(idempotency.stats()['replayed'], 1)
+
+        self.json_request('POST', self.path + '?rid=2', self.body, self.token)
+        self.assertEqual(len(self.comments()), 2)
+
+    def test_header_from_datastore(self):
+        headers = {'Authorization': self.token, idempotency.header: 'abc'}
+        first = self.request('POST', self.path, self.body, headers)
+        self.assertEqual(first.status_int, 200, first.body)
+        # Evicted from memcache
+        idempotency.memcache.flush_all()
+
+        again = self.request('POST', self.path, self.body, headers)
+        self.assertEqual(again.body, first.body)
+        self.assertEqual(len(self.comments()), 1)
+
+    def test_failed_request_released(self):
+        bad = dict(self.body)
+        del bad['content']
+        self.json_request('POST', self.path + '?rid=1', bad, self.token,
+                          status=400)
+        self.json_request('POST', self.path + '?rid=1', self.body, self.token)
+        self.assertEqual(len(self.comments()), 1)
+        self.assertEqual(idempotency.stats()['released'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python2
+'''Mapper tests (run with run-tests.sh)'''
+from datetime import datetime
+import unittest
+
+from base import TestCase, db
+from isrv import mapper
+
+
+class BackfillModerationTest(TestCase):
+    def setUp(self):
+        super(BackfillModerationTest, self).setUp()
+        self.user, _ = self.new_user()
+        self.post = self.new_post(self.user, [self.new_channel()])
+        self.mod_key = db.Moderation.key_for(self.post.key)
+
+    def old_flags(self, count):
+        '''Flags written before Moderation existed'''
+        db.ndb.put_multi([
+            db.Flag(parent=self.post.key, created=datetime(2020, 1, i + 1))
+            for i in range(count)])
+
+    def test_backfill(self):
+        self.old_flags(2)
+        db.Flag.create(self.post.key, datetime(2020, 2, 1))
+        mapper.BackfillModeration().run()
+        mod = self.mod_key.get()
+        self.assertEqual(mod.count, 3)
+        self.assertEqual(mod.last_flagged, datetime(2020, 2, 1))
+        self.assertFalse(self.post.key.get().hidden)
+
+    def test_rerun(self):
+        self.old_flags(db.flag_hide_threshold)
+        backfill = mapper.BackfillModeration()
+        backfill.run()
+        # A retried batch must not count the flags again
+        backfill.run()
+        self.assertEqual(self.mod_key.get().count, db.flag_hide_threshold)
+        self.assertTrue(self.post.key.get().hidden)
+
+    def test_flagged_channel(self):
+        # Channels have no hidden property
+        chan_key = db.decode_key(self.new_channel('other'))
+        db.ndb.put_multi([db.Flag(parent=chan_key)
+                          for i in range(db.flag_hide_threshold)])
+        mapper.BackfillModeration().run()
+        mod = db.Moderation.key_for(chan_key).get()
+        self.assertEqual(mod.count, db.flag_hide_threshold)
+
+
+if __name__ == '__main__':
+    unittest.main()